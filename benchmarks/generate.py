@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+
+"""Generate a large journal and price file for benchmarking.
+
+The journal uses the features that matter for performance: deep account
+trees with aliases, several currencies, many securities bought and sold
+with "@" unit rates or explicit lots, virtual postings, elided postings
+and balance assertions. It parses pedantically, and once unit rates are
+expanded (as rewrite.py does) it passes verify.py.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import string
+
+# Currencies and their precision.
+CURRENCIES = {"USD": 2, "EUR": 2, "GBP": 2, "CHF": 2, "INR": 2, "JPY": 0}
+
+PAYEES = ["Supermarket", "Fuel Station", "Bookshop", "Pharmacy", "Cinema",
+          "Restaurant", "Hardware Store", "Airline", "Hotel", "Utility"]
+
+START_DATE = datetime.date(2000, 1, 1)
+
+def security_names(n: int) -> list[str]:
+    # Unquoted commodities may not contain digits.
+    names = []
+    for i in range(n):
+        name = ""
+        for _ in range(3):
+            i, r = divmod(i, 26)
+            name = string.ascii_uppercase[r] + name
+        names.append(name)
+    return names
+
+def expense_accounts(depth: int, fanout: int) -> list[str]:
+    accounts = ["Expenses"]
+    for level in range(1, depth):
+        accounts = [f"{a}:Level {level} Group {i}"
+                    for a in accounts for i in range(fanout)]
+    return accounts
+
+def format_quantity(units: int, precision: int) -> str:
+    sign = "-" if units < 0 else ""
+    units = abs(units)
+    if not precision:
+        return f"{sign}{units}"
+    whole, frac = divmod(units, 10 ** precision)
+    return f"{sign}{whole}.{frac:0{precision}d}"
+
+def currency_amount(commodity: str, units: int) -> str:
+    return f"{commodity} {format_quantity(units, CURRENCIES[commodity])}"
+
+class Generator():
+    def __init__(self, transactions: int, securities: int, depth: int,
+                 seed: int):
+        self.random = random.Random(seed)
+        self.transactions = transactions
+        self.days = min(max(transactions // 20, 365), 25 * 365)
+        self.securities = security_names(securities)
+        # Deep trees: every expense account is `depth` levels deep.
+        self.expenses = expense_accounts(depth, 4)
+        self.budgets = [f"Budget:Envelope {i}" for i in range(16)]
+        self.incomes = ["Income:Salary:Base", "Income:Salary:Bonus",
+                        "Income:Interest"]
+        self.banks = {c: f"Assets:Bank:{c}" for c in CURRENCIES}
+        self.aliases = {c: f"bank{c.lower()}" for c in CURRENCIES}
+        # Running balances used to write balance assertions, and holdings
+        # so that nothing is sold short.
+        self.bank_balances = {c: 0 for c in CURRENCIES}
+        self.holdings = {s: 0 for s in self.securities}
+        # Prices in cents, following a random walk.
+        self.prices = {s: self.random.randint(500, 50000)
+                       for s in self.securities}
+        self.rates = {c: self.random.randint(50, 20000)
+                      for c in CURRENCIES if c != "USD"}
+
+    def date(self, i: int, total: int) -> datetime.date:
+        return START_DATE + datetime.timedelta(days=i * self.days // total)
+
+    def write_declarations(self, f):
+        for c, precision in CURRENCIES.items():
+            f.write(f"commodity {c}\n")
+            f.write(f"  format {currency_amount(c, 100000 * 10 ** precision)}"
+                    "\n")
+            if c == "USD":
+                f.write("  default\n")
+        for s in self.securities:
+            f.write(f"commodity {s}\n")
+        f.write("\n")
+        for c in CURRENCIES:
+            f.write(f"account {self.banks[c]}\n")
+            f.write(f"  alias {self.aliases[c]}\n")
+        for a in ["Assets:Broker:Cash", "Equity:Opening Balances",
+                  "Equity:Trading:Securities", "Equity:Trading:Currency",
+                  "Income:Capital Gains", "Income:Capital Losses"]:
+            f.write(f"account {a}\n")
+        for s in self.securities:
+            f.write(f"account Assets:Broker:{s}\n")
+        for a in self.incomes + self.budgets + self.expenses:
+            f.write(f"account {a}\n")
+        f.write("\n")
+
+    def bank(self, currency: str) -> str:
+        if self.random.random() < 0.5:
+            return self.aliases[currency]
+        return self.banks[currency]
+
+    def expense(self, date, currency) -> str:
+        r = self.random
+        units = r.randint(100, 20000) // 10 ** (2 - CURRENCIES[currency])
+        self.bank_balances[currency] -= units
+        account = r.choice(self.expenses)
+        lines = [f"{date:%Y/%m/%d} * {r.choice(PAYEES)}"]
+        if r.random() < 0.1:
+            lines.append("  ; Paid by card.")
+        if r.random() < 0.15:
+            # Elide the expense and assert the bank balance instead.
+            balance = currency_amount(currency, self.bank_balances[currency])
+            lines.append(f"  {account}")
+            lines.append(f"  {self.bank(currency)}  "
+                         f"{currency_amount(currency, -units)} = {balance}")
+        else:
+            if currency == "USD" and r.random() < 0.3:
+                amount = format_quantity(units, 2)
+            else:
+                amount = currency_amount(currency, units)
+            lines.append(f"  {account}  {amount}")
+            lines.append(f"  {self.bank(currency)}")
+        if r.random() < 0.2:
+            lines.append(f"  ({r.choice(self.budgets)})  "
+                         f"{currency_amount(currency, -units)}")
+        return "\n".join(lines)
+
+    def income(self, date, currency) -> str:
+        r = self.random
+        units = r.randint(100000, 1000000)
+        units //= 10 ** (2 - CURRENCIES[currency])
+        self.bank_balances[currency] += units
+        return (f"{date:%Y/%m/%d} * Employer\n"
+                f"  {self.bank(currency)}  {currency_amount(currency, units)}\n"
+                f"  {r.choice(self.incomes)}")
+
+    def transfer_to_broker(self, date) -> str:
+        units = self.random.randint(100000, 5000000)
+        self.bank_balances["USD"] -= units
+        return (f"{date:%Y/%m/%d} * Broker deposit\n"
+                f"  Assets:Broker:Cash  {currency_amount('USD', units)}\n"
+                f"  {self.bank('USD')}")
+
+    def buy(self, date) -> str:
+        r = self.random
+        s = r.choice(self.securities)
+        q = r.randint(1, 100)
+        price = self.prices[s]
+        cost = currency_amount("USD", q * price)
+        paid = currency_amount("USD", -q * price)
+        unit = currency_amount("USD", price)
+        self.holdings[s] += q
+        if r.random() < 0.5:
+            return (f"{date:%Y/%m/%d} * Buy {s}\n"
+                    f"  Assets:Broker:{s}  {q} {s} @ {unit}\n"
+                    f"  Assets:Broker:Cash  {paid}")
+        # The form rewrite.py expands "@" purchases into.
+        lot = f"{{{unit}}} [{date:%Y/%m/%d}]"
+        return (f"{date:%Y/%m/%d} * Buy {s}\n"
+                f"  Assets:Broker:{s}  {q} {s} {lot}\n"
+                f"  Equity:Trading:Securities  -{q} {s} {lot}\n"
+                f"  Equity:Trading:Securities  {cost}\n"
+                f"  Assets:Broker:Cash  {paid}")
+
+    def sell(self, date) -> str | None:
+        r = self.random
+        held = [s for s in r.sample(self.securities,
+                                    min(8, len(self.securities)))
+                if self.holdings[s]]
+        if not held:
+            return None
+        s = held[0]
+        q = r.randint(1, self.holdings[s])
+        self.holdings[s] -= q
+        price = self.prices[s]
+        return (f"{date:%Y/%m/%d} * Sell {s}\n"
+                f"  Assets:Broker:{s}  -{q} {s} @ "
+                f"{currency_amount('USD', price)}\n"
+                f"  Assets:Broker:Cash  {currency_amount('USD', q * price)}")
+
+    def step_prices(self):
+        r = self.random
+        for s in r.sample(self.securities, min(4, len(self.securities))):
+            self.prices[s] = max(100, self.prices[s] + r.randint(-200, 200))
+
+    def write_journal(self, f):
+        f.write("; Generated by benchmarks/generate.py\n\n")
+        self.write_declarations(f)
+        r = self.random
+        currencies = list(CURRENCIES)
+        for i in range(self.transactions):
+            date = self.date(i, self.transactions)
+            x = r.random()
+            if i % 50 == 0:
+                txn = self.transfer_to_broker(date)
+            elif x < 0.70:
+                txn = self.expense(date, r.choice(currencies))
+            elif x < 0.80:
+                txn = self.income(date, r.choice(currencies))
+            elif x < 0.93:
+                txn = self.buy(date)
+            else:
+                txn = self.sell(date) or self.income(date, "USD")
+            self.step_prices()
+            f.write(txn)
+            f.write("\n\n")
+
+    def write_prices(self, f, count: int):
+        r = self.random
+        commodities = [(s, "USD") for s in self.securities] + \
+            [(c, "USD") for c in self.rates]
+        for i in range(count):
+            date = self.date(i, count)
+            s, c = commodities[(i * 7919) % len(commodities)]
+            if s in self.rates:
+                self.rates[s] = max(10, self.rates[s] + r.randint(-5, 5))
+                price = format_quantity(self.rates[s], 4)
+            else:
+                self.prices[s] = max(100, self.prices[s] +
+                                     r.randint(-200, 200))
+                price = format_quantity(self.prices[s], 2)
+            f.write(f"P {date:%Y/%m/%d} {s} {c} {price}\n")
+
+def generate(directory: str, transactions: int, securities: int = 200,
+             depth: int = 6, seed: int = 0) -> tuple[str, str]:
+    """Write journal-N.ledger and prices-N.ledger unless they exist."""
+    os.makedirs(directory, exist_ok=True)
+    journal = os.path.join(directory, f"journal-{transactions}.ledger")
+    prices = os.path.join(directory, f"prices-{transactions}.ledger")
+    if os.path.exists(journal) and os.path.exists(prices):
+        return (journal, prices)
+    g = Generator(transactions, securities, depth, seed)
+    for path, write in [(journal, g.write_journal),
+                        (prices, lambda f: g.write_prices(f, transactions))]:
+        with open(path + ".tmp", "w") as f:
+            write(f)
+        os.replace(path + ".tmp", path)
+    return (journal, prices)
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("transactions", type=int,
+                           help="number of transactions")
+    argparser.add_argument("--output", type=str, default="benchmarks/data",
+                           help="output directory")
+    argparser.add_argument("--securities", type=int, default=200,
+                           help="number of securities")
+    argparser.add_argument("--depth", type=int, default=6,
+                           help="depth of the expense account tree")
+    argparser.add_argument("--seed", type=int, default=0,
+                           help="random seed")
+    return argparser.parse_args()
+
+def main():
+    args = parse_args()
+    journal, prices = generate(args.output, args.transactions,
+                               args.securities, args.depth, args.seed)
+    print(journal)
+    print(prices)
+
+if __name__ == "__main__":
+    main()
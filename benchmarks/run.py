@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+
+"""Time the main operations on generated journals of increasing size.
+
+Results are written as JSON, one entry per (size, benchmark), so runs of
+different revisions can be compared.
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import generate
+from uledger3.exchange import Exchange
+from uledger3.ledger import Account
+from uledger3.ledger import transaction_has_unit_rates
+from uledger3.parser import PriceDecl, Transaction
+from uledger3.printing import print_account_balance
+from uledger3.util import read_journal, apply_journal, apply_transaction, \
+    BalanceHistory
+
+def load_script(name: str):
+    directory = os.environ.get("ULEDGER3_SCRIPTS") or \
+        os.path.join(_ROOT, "uledger3-scripts")
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(directory, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class Timer():
+    def __init__(self, size: int):
+        self.size = size
+        self.results = []
+
+    @contextlib.contextmanager
+    def __call__(self, name: str, **info):
+        start = time.perf_counter()
+        yield info
+        seconds = time.perf_counter() - start
+        self.results.append(dict(transactions=self.size, benchmark=name,
+                                 seconds=round(seconds, 4), **info))
+        print(f"{self.size:>10} {name:<24} {seconds:10.3f}s", flush=True)
+
+def expand_unit_rates(rewrite, journal):
+    # What rewrite.py does, without printing.
+    root = Account("root")
+    for i in journal.contents:
+        if not isinstance(i, Transaction):
+            continue
+        if transaction_has_unit_rates(i):
+            rewrite.expand_and_apply_unit_rate(
+                i, root, journal.get_commodity_format)
+        else:
+            apply_transaction(i, root, real=True, lots=True)
+
+def run(size: int, directory: str, queries: int, seed: int) -> list[dict]:
+    verify = load_script("verify")
+    rewrite = load_script("rewrite")
+    path, prices_path = generate.generate(directory, size)
+    timer = Timer(size)
+
+    with timer("read_journal", bytes=os.path.getsize(path)):
+        journal, lines = read_journal(path, cache="")
+    with timer("rewrite_unit_rates"):
+        expand_unit_rates(rewrite, journal)
+    root = Account("root")
+    with timer("apply_journal"):
+        apply_journal(journal, root)
+    lots = Account("root")
+    with timer("apply_journal_lots"):
+        apply_journal(journal, lots, lots=True)
+    deferred = Account("root", deferred=True)
+    with timer("apply_journal_deferred"):
+        apply_journal(journal, deferred)
+        deferred.balance
+    fixed_point = Account("root", fixed_point=True)
+    with timer("apply_journal_fixed_point"):
+        apply_journal(journal, fixed_point)
+    approximate = Account("root", approximate=True)
+    with timer("apply_journal_approximate"):
+        apply_journal(journal, approximate)
+    parallel = Account("root")
+    jobs = min(os.cpu_count() or 1, 4)
+    with timer("apply_journal_parallel", jobs=jobs):
+        apply_journal(journal, parallel, jobs=jobs)
+    with timer("print_account_balance"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            print_account_balance(root, journal.get_commodity_format)
+    with timer("verify_check_journal"):
+        verify.check_journal(journal, lines)
+    with timer("balance_history"):
+        history = BalanceHistory(journal, monthly=True)
+    r = random.Random(seed)
+    dates = [i.date for i in journal.contents if isinstance(i, Transaction)]
+    dates = [r.choice(dates) for _ in range(100)]
+    with timer("balance_history_queries", queries=len(dates)):
+        for i in dates:
+            history.balance(i)
+    del journal, lines, root, lots, deferred, fixed_point, approximate, \
+        parallel, history
+
+    with timer("read_prices", bytes=os.path.getsize(prices_path)):
+        prices, _ = read_journal(prices_path, pedantic=False, cache="")
+    exchange = Exchange()
+    commodities = set()
+    first = last = None
+    with timer("exchange_add_price"):
+        for i in prices.contents:
+            if isinstance(i, PriceDecl):
+                exchange.add_price(i.date, i.commodity,
+                                   i.price.commodity, i.price.quantity)
+                commodities.add(i.commodity)
+                target = i.price.commodity
+                first = first or i.date
+                last = i.date
+    with timer("exchange_load_prices"):
+        Exchange().load_prices(
+            (i.date, i.commodity, i.price.commodity, i.price.quantity)
+            for i in prices.contents if isinstance(i, PriceDecl))
+    del prices
+    r = random.Random(seed)
+    commodities = sorted(commodities)
+    span = (last - first).days
+    requests = [(first + datetime.timedelta(days=r.randint(0, span)),
+                 r.choice(commodities), r.choice(commodities))
+                for _ in range(queries)]
+    with timer("exchange_get_price", queries=queries):
+        for date, src, dst in requests:
+            exchange.get_price(date, src, dst)
+    # Reports convert everything into one commodity.
+    with timer("exchange_get_price_target", queries=queries):
+        for date, src, _ in requests:
+            exchange.get_price(date, src, target)
+    with timer("exchange_convert", queries=queries):
+        exchange.convert([(date, src, 1) for date, src, _ in requests],
+                         target)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in timer.results:
+        i["max_rss_kb"] = rss
+    return timer.results
+
+def revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True, cwd=_ROOT).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--sizes", type=int, nargs="+",
+                           default=[10000, 100000],
+                           help="numbers of transactions to benchmark")
+    argparser.add_argument("--data", type=str, default="benchmarks/data",
+                           help="directory for generated journals")
+    argparser.add_argument("--queries", type=int, default=10000,
+                           help="number of get_price queries")
+    argparser.add_argument("--seed", type=int, default=0,
+                           help="random seed for queries")
+    argparser.add_argument("--output", type=str,
+                           default="bench_results.json",
+                           help="results file")
+    return argparser.parse_args()
+
+def main():
+    args = parse_args()
+    results = []
+    for size in args.sizes:
+        # Each size runs in a fresh process so that peak memory is per size.
+        results.extend(run_isolated(size, args))
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print(f"Results written to {args.output}")
+
+def run_isolated(size: int, args) -> list[dict]:
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            results = run(size, args.data, args.queries, args.seed)
+            with os.fdopen(w, "w") as f:
+                json.dump(results, f)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        sys.exit(f"Benchmark of {size} transactions failed.")
+    return json.loads(data)
+
+if __name__ == "__main__":
+    main()
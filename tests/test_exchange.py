@@ -3,40 +3,49 @@ from datetime import datetime
 from decimal import Decimal
 
 import uledger3.exchange as exchange
+from uledger3.ledger import Balance
+from uledger3.parser import Amount, Lot
 
 class TestExchange(unittest.TestCase):
 
     def test_search_date(self):
         x = [
-            (datetime(2001, 2, 3), 0.1),
+            (datetime(2001, 2, 3), Decimal("0.1")),
 
-            (datetime(2002, 2, 3), 0.1),
-            (datetime(2002, 2, 3), 0.4),
-            (datetime(2002, 2, 3), 0.5),
+            (datetime(2002, 2, 3), Decimal("0.1")),
+            (datetime(2002, 2, 3), Decimal("0.4")),
+            (datetime(2002, 2, 3), Decimal("0.5")),
 
-            (datetime(2003, 2, 3), 0.5),
+            (datetime(2003, 2, 3), Decimal("0.5")),
 
-            (datetime(2009, 2, 3), 0.7),
-            (datetime(2009, 2, 3), 9.5),
+            (datetime(2009, 2, 3), Decimal("9.5")),
+            (datetime(2009, 2, 3), Decimal("0.7")),
 
-            (datetime(2009, 2, 4), 8.5),
+            (datetime(2009, 2, 4), Decimal("8.5")),
 
-            (datetime(2019, 2, 4), 9.6),
+            (datetime(2019, 2, 4), Decimal("9.6")),
         ]
-        self.assertEqual(exchange._search_date(x, datetime(2001, 2, 3)),
-                         (datetime(2001, 2, 3), 0.1))
-        self.assertEqual(exchange._search_date(x, datetime(2001, 3, 3)),
-                         (datetime(2001, 2, 3), 0.1))
-        self.assertEqual(exchange._search_date(x, datetime(2002, 3, 3)),
-                         (datetime(2002, 2, 3), 0.5))
-        self.assertEqual(exchange._search_date(x, datetime(2004, 3, 3)),
-                         (datetime(2003, 2, 3), 0.5))
-        self.assertEqual(exchange._search_date(x, datetime(2009, 2, 3)),
-                         (datetime(2009, 2, 3), 9.5))
-        self.assertEqual(exchange._search_date(x, datetime(2029, 2, 3)),
-                         (datetime(2019, 2, 4), 9.6))
-        self.assertEqual(exchange._search_date(x, datetime(2000, 2, 3)),
-                         None)
+        series = exchange._PriceSeries("ABC")
+        # Out of order, but each date's prices in order.
+        for date, quantity in x[4:] + x[:4]:
+            series.append(exchange._date_key(date), quantity, "ABC")
+
+        def search(date):
+            i = series.index(date)
+            if i < 0:
+                return None
+            return (exchange._key_date(series.keys[i]),
+                    series.quantity(i, "ABC"))
+
+        self.assertEqual(search(datetime(2001, 2, 3)), x[0])
+        self.assertEqual(search(datetime(2001, 3, 3)), x[0])
+        self.assertEqual(search(datetime(2002, 3, 3)), x[3])
+        self.assertEqual(search(datetime(2004, 3, 3)), x[4])
+        self.assertEqual(search(datetime(2009, 2, 3)), x[6])
+        self.assertEqual(search(datetime(2029, 2, 3)), x[8])
+        self.assertEqual(search(None), x[8])
+        self.assertEqual(search(datetime(2000, 2, 3)), None)
+        self.assertEqual(series.index(datetime(2009, 2, 4), 6), 7)
 
     def test_get_price(self):
         x = exchange.Exchange()
@@ -72,3 +81,152 @@ class TestExchange(unittest.TestCase):
         self.assertEqual(p, Decimal("1.7") * Decimal("0.1"))
         p = x.get_price(datetime(2001, 2, 3), "USD", "XAU")
         self.assertEqual(p, Decimal("1.5") * Decimal("3.9") * Decimal("4.9"))
+
+    def test_get_price_approximate(self):
+        x = exchange.Exchange()
+        x.add_price(datetime(2001, 2, 1), "EUR", "JPY", Decimal("3.9"))
+        x.add_price(datetime(2001, 2, 1), "JPY", "XAU", Decimal("4.9"))
+        x.add_price(datetime(2001, 2, 3), "USD", "EUR", Decimal("1.1"))
+        for src, dst in [("USD", "XAU"), ("XAU", "USD"), ("EUR", "JPY")]:
+            exact = x.get_price(datetime(2001, 2, 3), src, dst)
+            p = x.get_price(datetime(2001, 2, 3), src, dst,
+                            approximate=True)
+            self.assertIsInstance(p.price, float)
+            self.assertGreater(p.error, 0)
+            self.assertLessEqual(abs(Decimal(p.price) - exact),
+                                 Decimal(p.error))
+        p = x.get_price(None, "USD", "USD", approximate=True)
+        self.assertEqual(p, (1.0, 0.0))
+        self.assertIsNone(x.get_price(datetime(2001, 2, 2), "USD", "XAU",
+                                      approximate=True))
+
+    def test_get_price_cache(self):
+        for size in [0, 1, 4096]:
+            x = exchange.Exchange(cache_size=size)
+            x.add_price(datetime(2001, 2, 1), "EUR", "JPY", Decimal("3.9"))
+            x.add_price(datetime(2001, 2, 3), "USD", "EUR", Decimal("1.5"))
+            for _ in range(2):
+                self.assertIsNone(x.get_price(None, "USD", "XAU"))
+                self.assertEqual(x.get_price(None, "USD", "JPY"),
+                                 Decimal("1.5") * Decimal("3.9"))
+                self.assertIsNone(x.get_price(datetime(2001, 2, 2),
+                                              "USD", "JPY"))
+            x.add_price(datetime(2001, 2, 2), "JPY", "XAU", Decimal("4.9"))
+            x.add_price(datetime(2001, 2, 2), "USD", "EUR", Decimal("1.4"))
+            self.assertEqual(x.get_price(None, "USD", "XAU"),
+                             Decimal("1.5") * Decimal("3.9") * Decimal("4.9"))
+            self.assertEqual(x.get_price(datetime(2001, 2, 2), "USD", "JPY"),
+                             Decimal("1.4") * Decimal("3.9"))
+
+    def test_get_price_freshest(self):
+        x = exchange.Exchange()
+        x.add_price(datetime(2001, 1, 1), "A", "C", Decimal("2"))
+        x.add_price(datetime(2001, 2, 1), "A", "B", Decimal("3"))
+        x.add_price(datetime(2001, 2, 1), "B", "C", Decimal("5"))
+        x.add_price(datetime(2001, 2, 1), "B", "D", Decimal("7"))
+        x.add_price(datetime(2001, 2, 1), "C", "D", Decimal("11"))
+        date = datetime(2001, 2, 2)
+        self.assertEqual(x.get_price(date, "A", "C"), Decimal("2"))
+        self.assertEqual(x.get_price(date, "A", "C", freshest=True),
+                         Decimal("15"))
+        self.assertEqual(x.get_price(None, "C", "A", freshest=True),
+                         Decimal(1) / Decimal(5) * (Decimal(1) / Decimal(3)))
+        self.assertEqual(x.get_price(date, "B", "D", freshest=True),
+                         Decimal("7"))
+        self.assertEqual(x.get_price(date, "A", "D", freshest=True),
+                         Decimal("21"))
+        date = datetime(2001, 1, 2)
+        self.assertEqual(x.get_price(date, "A", "C", freshest=True),
+                         Decimal("2"))
+        self.assertIsNone(x.get_price(date, "A", "D", freshest=True))
+
+    def test_convert(self):
+        x = exchange.Exchange()
+        x.add_price(datetime(2001, 2, 1), "EUR", "JPY", Decimal("3.9"))
+        x.add_price(datetime(2001, 2, 3), "USD", "EUR", Decimal("1.5"))
+        x.add_price(datetime(2001, 2, 5), "USD", "EUR", Decimal("1.4"))
+        x.add_price(datetime(2001, 2, 4), "EUR", "JPY", Decimal("4.1"))
+        x.add_price(datetime(2001, 2, 2), "EUR", "JPY", Decimal("4.0"))
+        x.add_price(datetime(2001, 2, 4), "CHF", "USD", Decimal("0.9"))
+        dates = [None] + [datetime(2001, 2, i) for i in range(1, 7)]
+        requests = [(d, c, Decimal(i + 1))
+                    for i, d in enumerate(reversed(dates))
+                    for c in ["EUR", "USD", "CHF", "JPY", "XAU"]]
+        result = x.convert(requests, "JPY")
+        for (d, c, q), y in zip(requests, result):
+            p = x.get_price(d, c, "JPY")
+            self.assertEqual(y, None if p is None else q * p)
+        self.assertEqual(x.convert([], "JPY"), [])
+        self.assertEqual(x.convert([(None, "USD", Decimal(1))], "XAU"),
+                         [None])
+
+        b = Balance()
+        price = Amount(Decimal("2"), "USD")
+        b += Amount(Decimal("3"), Lot("ABC", datetime(2001, 2, 4), price))
+        b += Amount(Decimal("5"), Lot("ABC", datetime(2001, 2, 1), price))
+        b += Amount(Decimal("7"), "USD")
+        b += Amount(Decimal("11"), "JPY")
+        b += Amount(Decimal("13"), "XAU")
+        c = x.convert_balance(b, "JPY")
+        p = Decimal("1.5") * Decimal("4.1")
+        lot = Lot("ABC", datetime(2001, 2, 4), Amount(2 * p, "JPY"))
+        self.assertEqual(c[lot], Decimal("3"))
+        lot = Lot("ABC", datetime(2001, 2, 1), price)
+        self.assertEqual(c[lot], Decimal("5"))
+        p = Decimal("1.4") * Decimal("4.1")
+        self.assertEqual(c["JPY"], 7 * p + 11)
+        self.assertEqual(c["XAU"], Decimal("13"))
+        self.assertEqual(len(c), 4)
+
+    def test_load_prices(self):
+        prices = [
+            (datetime(2001, 2, 3), "USD", "EUR", Decimal("1.5")),
+            (datetime(2001, 2, 1), "EUR", "JPY", Decimal("3.9")),
+            (datetime(2001, 2, 5, 12, 30), "USD", "EUR", Decimal("1.4")),
+            (datetime(2001, 2, 3), "USD", "EUR", Decimal("1.6")),
+            (datetime(2001, 2, 2), "EUR", "USD", Decimal("0.7")),
+        ]
+        x = exchange.Exchange()
+        for i in prices:
+            x.add_price(*i)
+        y = exchange.Exchange()
+        y.load_prices(prices[:2])
+        y.load_prices(iter(prices[2:]))
+        dates = [None] + [datetime(2001, 2, i) for i in range(1, 7)] + \
+            [datetime(2001, 2, 5, 12, 29), datetime(2001, 2, 5, 12, 30)]
+        for d in dates:
+            for src, dst in [("USD", "EUR"), ("EUR", "USD"), ("USD", "JPY")]:
+                self.assertEqual(x.get_price(d, src, dst),
+                                 y.get_price(d, src, dst))
+        self.assertEqual(y.get_price(datetime(2001, 2, 4), "USD", "EUR"),
+                         Decimal("1.6"))
+        self.assertEqual(y.get_price(datetime(2001, 2, 5), "USD", "EUR"),
+                         Decimal("1.6"))
+        self.assertEqual(y.get_price(None, "USD", "EUR"), Decimal("1.4"))
+        self.assertEqual(y.get_price(datetime(2001, 2, 2), "EUR", "USD"),
+                         Decimal("0.7"))
+        for d in dates[1:]:
+            self.assertEqual(exchange._key_date(exchange._date_key(d)), d)
+
+    def test_inverse_prices(self):
+        prices = [
+            (datetime(2001, 2, 1), "USD", "EUR", Decimal("1.5")),
+            (datetime(2001, 2, 2), "EUR", "USD", Decimal("0.7")),
+            (datetime(2001, 2, 2), "USD", "EUR", Decimal("1.3")),
+            (datetime(2001, 2, 3), "EUR", "USD", Decimal("0.8")),
+        ]
+        for cache_inverses in [False, True]:
+            x = exchange.Exchange(cache_inverses=cache_inverses)
+            x.load_prices(prices)
+            usd = x._commodities["USD"]
+            self.assertIs(usd.prices("EUR"),
+                          x._commodities["EUR"].prices("USD"))
+            self.assertEqual(len(usd.prices("EUR").quantities), 4)
+            for _ in range(2):
+                for d, p in [(1, Decimal("1.5")), (2, Decimal("1.3")),
+                             (3, 1/Decimal("0.8"))]:
+                    date = datetime(2001, 2, d)
+                    self.assertEqual(x.get_price(date, "USD", "EUR"), p)
+                    self.assertEqual(x.get_price(date, "EUR", "USD"), 1/p
+                                     if d != 3 else Decimal("0.8"))
+                    self.assertEqual(usd.get_price(date, "EUR"), (date, p))
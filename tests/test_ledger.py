@@ -1,3 +1,5 @@
+import pickle
+import random
 import unittest
 from datetime import datetime
 from decimal import Decimal
@@ -6,6 +8,7 @@ import uledger3.parser as parser
 from uledger3.parser import Amount, Lot, Transaction, \
     Posting, Position, Journal, Entity
 import uledger3.ledger as ledger
+import uledger3.printing as printing
 
 class TestParser(unittest.TestCase):
 
@@ -118,6 +121,50 @@ class TestParser(unittest.TestCase):
 
         ledger.check_transaction(p.journal.contents[6], lines=lines)
 
+    def test_transaction_normalised(self):
+        p = parser.Parser("test")
+        p.parse_lines([
+            "2021/11/03 payee",
+            "  acc1  EUR 15",
+            "  acc2",
+            "2021/11/03 payee",
+            "  acc1  EUR 15",
+            "  acc2  EUR -15",
+        ])
+        x, y = p.journal.contents
+        self.assertFalse(x.normalised)
+        ledger.check_transaction(x)
+        self.assertFalse(x.normalised)
+        ledger.unelide_transaction(x)
+        self.assertTrue(x.normalised)
+        self.assertEqual(x.contents[1].amount, Amount(Decimal(-15), "EUR"))
+        ledger.unelide_transaction(x)
+        self.assertEqual(len(x.contents), 2)
+        ledger.check_transaction(y)
+        self.assertTrue(y.normalised)
+        y.contents.append(Posting("acc3", Amount(Decimal(1), "EUR")))
+        self.assertFalse(y.normalised)
+        with self.assertRaises(ledger.BalanceError):
+            ledger.check_transaction(y)
+        y.contents = y.contents[:2]
+        self.assertFalse(y.normalised)
+        ledger.unelide_transaction(y)
+        self.assertTrue(y.normalised)
+        y.contents[1] = Posting("acc2", Amount(Decimal(-5), "EUR"))
+        self.assertFalse(y.normalised)
+        with self.assertRaises(ledger.BalanceError):
+            ledger.check_transaction(y)
+        y.contents[1].amount = Amount(Decimal(-15), "EUR")
+        ledger.check_transaction(y)
+        self.assertTrue(y.normalised)
+        y.contents[0].amount = Amount(Decimal(5), "EUR")
+        with self.assertRaises(ledger.BalanceError):
+            ledger.check_transaction(y)
+        y.contents[0].amount = Amount(Decimal(15), "EUR")
+        y.contents[0].account = "(acc1)"
+        with self.assertRaises(ledger.BalanceError):
+            ledger.check_transaction(y)
+
     def test_account(self):
         a = ledger.Account("root")
         p = Posting("Assets:Checking",
@@ -178,6 +225,215 @@ class TestParser(unittest.TestCase):
         x = a["A:B"].balance_excluding_children()
         self.assertEqual(x["JPY"], Decimal("13"))
 
+    def test_account_deferred(self):
+        a = ledger.Account("root")
+        b = ledger.Account("root", deferred=True)
+        postings = [("A:B:C", "6", "JPY"), ("A:B:D", "7", "JPY"),
+                    ("A:B", "13", "JPY"), ("A:B", "12", "ABC"),
+                    ("A:B:X", "-12", "ABC"), ("E", "1", "JPY"),
+                    ("A:B:C", "-6", "JPY"), ("A", "2", "EUR")]
+        for account, quantity, commodity in postings:
+            for x in (a, b):
+                x.apply(Posting(account, Amount(Decimal(quantity), commodity)))
+            self.assertTrue(b[account].deferred)
+            self.assertEqual(a.balance, b.balance)
+            self.assertEqual(a["A:B"].balance, b["A:B"].balance)
+        for i in ["A", "A:B", "A:B:C", "A:B:X", "E"]:
+            self.assertEqual(a[i].balance, b[i].balance)
+            self.assertEqual(a[i].balance_excluding_children(),
+                             b[i].balance_excluding_children())
+        self.assertEqual(b["A:B:C"].balance, 0)
+        self.assertEqual(b["A"].balance["ABC"], 0)
+        b["A:B:C"] -= Amount(Decimal(4), "JPY")
+        self.assertEqual(b.balance["JPY"], Decimal(17))
+        b["A:B"] = ledger.Account("B", b["A"])
+        self.assertEqual(b["A"].balance["JPY"], 0)
+        self.assertEqual(b["A"].balance["EUR"], Decimal(2))
+        self.assertEqual(b.balance["JPY"], Decimal(1))
+
+    def test_fixed_point_balance(self):
+        self.assertEqual(parser.decimal_units(Decimal("-12.50")), (-1250, 2))
+        self.assertEqual(parser.decimal_units(Decimal("3E+2")), (3, -2))
+        r = random.Random(0)
+        a = ledger.Account("root")
+        b = ledger.Account("root", fixed_point=True)
+        c = ledger.Account("root", deferred=True, fixed_point=True)
+        quantities = ["0", "1", "-1", "1.5", "-1.50", "0.001", "2.25",
+                      "-0.25", "1E+2", "-100", "0.000"]
+        for i in range(500):
+            account = r.choice(["A", "A:B", "A:B:C", "A:D", "E"])
+            amount = Amount(Decimal(r.choice(quantities)),
+                            r.choice(["ABC", "JPY"]))
+            add = r.random() < 0.5
+            for x in (a, b, c):
+                if add:
+                    x[account] += amount
+                else:
+                    x[account] -= amount
+            # Exponents must match too, so compare the printed quantities.
+            # A deferred tree adds in a different order, so only the values
+            # are the same.
+            exact = lambda b: sorted((i, str(b[i])) for i in b)
+            self.assertEqual(exact(a.balance), exact(b.balance))
+            self.assertEqual(
+                exact(a[account].balance_excluding_children()),
+                exact(b[account].balance_excluding_children()))
+            for x in (b, c):
+                self.assertEqual(a.balance, x.balance)
+                self.assertEqual(a[account].balance, x[account].balance)
+                self.assertEqual(a[account].balance_excluding_children(),
+                                 x[account].balance_excluding_children())
+        self.assertIsInstance(b["A:B"].balance, ledger.FixedPointBalance)
+        x = b["A"].balance.copy()
+        x["XYZ"] = Decimal("1.10")
+        x["ABC"] = Decimal(0)
+        self.assertEqual(str(x["XYZ"]), "1.10")
+        self.assertNotIn("ABC", x)
+        self.assertEqual(x.pop("XYZ"), Decimal("1.1"))
+        self.assertIsNone(x.pop("XYZ", None))
+        with self.assertRaises(TypeError):
+            x += Amount(2, "CHF")
+
+    def test_merge_into_empty_balance(self):
+        b = ledger.Balance()
+        b += Amount(Decimal("1.50"), "ABC")
+        for cls in [ledger.FixedPointBalance, ledger.ApproximateBalance]:
+            for method in ["_merge", "_assign"]:
+                x = cls()
+                getattr(x, method)(b)
+                self.assertEqual(x["ABC"], Decimal("1.5"))
+                x += Amount(Decimal("0.25"), "ABC")
+                self.assertEqual(x["ABC"], Decimal("1.75"))
+                if cls is ledger.ApproximateBalance:
+                    self.assertIsInstance(x["ABC"], float)
+                    self.assertGreater(x.error("ABC"), 0)
+
+    def test_approximate_balance(self):
+        r = random.Random(0)
+        a = ledger.Account("root")
+        b = ledger.Account("root", approximate=True)
+        c = ledger.Account("root", deferred=True, approximate=True)
+        quantities = ["0.1", "0.2", "-0.3", "1.01", "-2.02", "1E+2", "0"]
+        accounts = ["A", "A:B", "A:B:C", "E"]
+        for i in range(500):
+            account = r.choice(accounts)
+            amount = Amount(Decimal(r.choice(quantities)), "ABC")
+            for x in (a, b, c):
+                x[account] += amount
+            for x in (b, c):
+                pairs = [(a, x)] + [(a[i], x[i]) for i in accounts]
+                for exact, approx in pairs:
+                    q = approx.balance["ABC"]
+                    self.assertIsInstance(q, float)
+                    self.assertLessEqual(
+                        abs(Decimal(q) - exact.balance["ABC"]),
+                        Decimal(approx.balance.error("ABC")))
+        self.assertEqual(b["E"].balance_excluding_children()["ABC"],
+                         b["E"].balance["ABC"])
+        x = ledger.Account("root", approximate=True)
+        x["A"] += Amount(Decimal("0.1"), "ABC")
+        x["A"] += Amount(Decimal("0.2"), "ABC")
+        x["A"] -= Amount(Decimal("0.3"), "ABC")
+        self.assertEqual(x.balance, 0)
+        self.assertGreater(x.balance.error("ABC"), 0)
+        with self.assertRaises(TypeError):
+            x["A"] += Amount(2, "ABC")
+        with self.assertRaises(ValueError):
+            ledger.Account("root", fixed_point=True, approximate=True)
+
+    def test_balance_pickle(self):
+        for kind in [{}, {"fixed_point": True}, {"approximate": True}]:
+            a = ledger.Account("root", **kind)
+            a["A:B"] += Amount(Decimal("0.10"), "ABC")
+            a["A"] += Amount(Decimal("2"), "ABC")
+            a["C"] += Amount(Decimal("-1.5"), "XYZ")
+            b = pickle.loads(pickle.dumps(a))
+            for i in ["A", "A:B", "C"]:
+                x, y = a[i].balance, b[i].balance
+                self.assertIs(type(x), type(y))
+                self.assertEqual(x, y)
+                self.assertEqual(repr(x), repr(y))
+            if kind.get("approximate"):
+                self.assertEqual(b["A"].balance.error("ABC"),
+                                 a["A"].balance.error("ABC"))
+            b["A:B"] += Amount(Decimal("1"), "ABC")
+            self.assertEqual(b.balance["ABC"], a.balance["ABC"] + 1)
+
+    def test_account_lookup(self):
+        a = ledger.Account("root")
+        x = a["A: B :C"]
+        self.assertIs(a["A:B:C"], x)
+        self.assertIs(a["A: B :C"], x)
+        self.assertIs(a["A"]["B:C"], x)
+        a["A:B:C"] += Amount(Decimal(1), "JPY")
+        self.assertIs(a["A:B:C"], x)
+        y = ledger.Account("B", a["A"])
+        a["A:B"] = y
+        self.assertIs(a["A:B"], y)
+        self.assertIsNot(a["A:B:C"], x)
+        self.assertIs(a["A"]["B:C"], a["A:B:C"])
+        with self.assertRaises(ValueError):
+            a["A::C"]
+        with self.assertRaises(ValueError):
+            a["A::C"]
+
+    def test_account_summary(self):
+        def deep_empty(a):
+            return a.balance == 0 and \
+                all(deep_empty(i) for i in a.children.values())
+        def check(a):
+            nonempty = [i for i in a.children.values() if not deep_empty(i)]
+            self.assertEqual(a.is_deep_empty(), deep_empty(a))
+            self.assertEqual(a.count_nonempty_children(), len(nonempty))
+            self.assertIs(a.nonempty_child(),
+                          nonempty[0] if len(nonempty) == 1 else None)
+            for i in a.children.values():
+                check(i)
+        r = random.Random(0)
+        names = ["A", "A:B", "A:B:C", "A:D", "E", "E:F"]
+        for deferred in [False, True]:
+            a = ledger.Account("root", deferred=deferred)
+            check(a)
+            for _ in range(200):
+                x = Amount(Decimal(r.randint(-2, 2)), r.choice(["INR", "USD"]))
+                name = r.choice(names)
+                if r.random() < 0.5:
+                    a[name] += x
+                else:
+                    a[name] -= x
+                if r.random() < 0.3:
+                    check(a)
+            check(a)
+            a["A"] = ledger.Account("A", a)
+            check(a)
+
+    def test_account_sorted(self):
+        a = ledger.Account("root")
+        for i in ["C", "A:X", "B"]:
+            a[i] += Amount(Decimal(1), "INR")
+        self.assertEqual(a.sorted_children(), ["A", "B", "C"])
+        x = a.sorted_children()
+        x.append("D")
+        self.assertEqual(a.sorted_children(), ["A", "B", "C"])
+        a["AA"]
+        self.assertEqual(a.sorted_children(), ["A", "AA", "B", "C"])
+        a["B"] = ledger.Account("Z", a)
+        self.assertEqual(a.sorted_children(), ["A", "AA", "C", "Z"])
+        self.assertEqual(a.sorted_children(lambda x: x.name == "C"),
+                         ["A", "Z", "AA", "C"])
+        price = Amount(Decimal(1), "INR")
+        lot_1 = Lot("ABC", datetime(2020, 1, 2), price)
+        lot_2 = Lot("ABC", datetime(2019, 12, 31), price)
+        b = ledger.Balance()
+        b[lot_1] = Decimal(1)
+        b["ABC"] = Decimal(1)
+        b[lot_2] = Decimal(1)
+        self.assertEqual(sorted(b, key=ledger.lexorder_commodity),
+                         ["ABC", lot_2, lot_1])
+        self.assertEqual(lot_1.sort_key, "ABC 2020/01/02")
+        self.assertEqual(lot_1.sort_key,
+                         f"ABC {printing.date2str(lot_1.date)}")
+
     def test_read_uledger_comment(self):
         x = "; [uledger] abc -- 123"
         self.assertEqual(ledger.read_uledger_comment(x),
@@ -1,4 +1,5 @@
 import unittest
+import pickle
 from datetime import datetime
 from decimal import Decimal
 
@@ -20,6 +21,8 @@ class TestParser(unittest.TestCase):
         self.assertEqual(x, (None, 0))
         x = parser.parse_date("2004-01/02", 10)
         self.assertEqual(x, (None, 10))
+        x = parser.parse_date("P 2004-01-02", 2)
+        self.assertIs(x[0], parser.parse_date("2004-01-02")[0])
 
     def test_parse_lot_date(self):
         x = parser.parse_lot_date("[2004/01/02]brownjarsprevented")
@@ -46,6 +49,7 @@ class TestParser(unittest.TestCase):
         self.assertEqual(x, (None, 0))
         x = parser.parse_quantity("123456.123456", 3)
         self.assertEqual(x, ((Decimal("456.123456"), False, 6), 13))
+        self.assertIs(x[0], parser.parse_quantity("$456.123456", 1)[0])
 
     def test_parse_commodity(self):
         x = parser.parse_commodity("-2004.9658/01/02brownjarsprevented")
@@ -157,6 +161,10 @@ class TestParser(unittest.TestCase):
         b = parser.CommodityFormat( True, 4, "right", False)
         self.assertEqual(l.journal.get_commodity_format("c1"), a)
         self.assertEqual(l.journal.get_commodity_format("c2"), b)
+        l._update_inferred_commodity_format("c1", z)
+        z = l.journal.get_commodity_format("c1")
+        l._update_inferred_commodity_format("c1", y)
+        self.assertIs(l.journal.get_commodity_format("c1"), z)
 
     def test_parser_parse_amount(self):
         l = parser.Parser("test")
@@ -313,3 +321,120 @@ class TestParser(unittest.TestCase):
         l.parse_line("  (2021/11/03 acc1)  EUR 17")
         l.parse_line("  2021/11/03 acc1")
         l.parse_line("  2021/11/03 acc2  EUR 15")
+
+    def test_parser_parse_line_dispatch(self):
+        l = parser.Parser("test")
+        l.parse_lines([
+            "commodity EUR",
+            "  format EUR 1,000.00",
+            "account Assets:Bank",
+            "  alias bank",
+            "tag abc",
+            "; comment",
+            "",
+            "P 2022/01/02 abc EUR 6",
+            "2022-01-03 * payee",
+            "  bank  EUR 15",
+            "  ; posting comment",
+            "  Expenses",
+        ])
+        x = [type(i).__name__ for i in l.journal.contents]
+        self.assertEqual(x, ["CommodityDecl", "AccountDecl", "str", "str",
+                             "str", "PriceDecl", "Transaction"])
+        self.assertEqual(l.journal.contents[-1].contents[0].account,
+                         "Assets:Bank")
+        self.assertEqual(l.journal.contents[-1].span.end,
+                         parser.Position(12, 9))
+        for line in ["Payee", "commodityEUR", "tog", "2022/01", "#"]:
+            with self.assertRaises(parser.ParseError) as e:
+                l.parse_line(line)
+            self.assertIn("column: ", str(e.exception))
+        with self.assertRaises(parser.ParseError) as e:
+            l.parse_line("Payee")
+        self.assertIn("Price declaration not well formed", str(e.exception))
+        with self.assertRaises(parser.ParseError) as e:
+            l.parse_line("x")
+        self.assertIn("Unable to parse line\nline: 19, column: 0",
+                      str(e.exception))
+
+    def test_parser_iter_entities(self):
+        l = parser.Parser("test")
+        lines = [
+            "commodity EUR",
+            "  format EUR 1,000.00",
+            "; comment",
+            "2022/01/03 payee",
+            "  acc1  EUR 15",
+            "",
+            "  acc2",
+        ]
+        x = l.iter_entities(lines)
+        self.assertIsInstance(next(x), parser.CommodityDecl)
+        self.assertEqual(l.journal.declared_commodity_formats["EUR"].comma,
+                         True)
+        txn = next(x)
+        self.assertIsInstance(txn, parser.Transaction)
+        self.assertEqual(len(txn.contents), 1)
+        with self.assertRaises(parser.ParseError):
+            next(x)
+        self.assertEqual(l.journal.contents, [])
+        l = parser.Parser("test")
+        x = list(l.iter_entities(lines[:5]))
+        self.assertEqual(len(x), 2)
+        self.assertEqual(x[1].span.end, parser.Position(5, 13))
+
+    def test_entity_span(self):
+        a = parser.Amount(Decimal("1"), "EUR")
+        self.assertIsNone(a.span)
+        span = parser.Span(parser.Position(70000, 2), parser.Position(70003, 9))
+        a.span = span
+        self.assertEqual(a.span, span)
+        self.assertIsInstance(a.span.start, parser.Position)
+        span = parser.Span(parser.Position(1, 2), parser.Position(1, 70000))
+        a.span = span
+        self.assertEqual(a.span, span)
+        with self.assertRaises(AttributeError):
+            a.note = "x"
+        l = parser.Parser("test")
+        l.parse_lines(["2022/01/03 payee", "  acc1  EUR 15", "  acc2"])
+        l.parse_line("2022/01/03 payee")
+        txn = l.journal.contents[0]
+        self.assertEqual(txn.span, parser.Span(parser.Position(1, 0),
+                                               parser.Position(3, 5)))
+        self.assertEqual(txn.contents[0].amount.span,
+                         parser.Span(parser.Position(2, 8),
+                                     parser.Position(2, 13)))
+        self.assertIs(txn.date, l.journal.contents[1].date)
+
+    def test_parser_intern(self):
+        l = parser.Parser("test")
+        l.parse_lines([
+            "2022/01/03 payee",
+            "  acc1  15 ABC {EUR 1.0} [2022/01/01]",
+            "  acc2  EUR -15",
+            "2022/01/04 payee",
+            "  acc1  1 ABC {EUR 1.0} [2022/01/01]",
+            "  acc1  1 ABC {EUR 1.00} [2022/01/01]",
+            "  acc2",
+        ])
+        x, y = l.journal.contents
+        self.assertIs(x.contents[0].account, y.contents[0].account)
+        self.assertIs(x.contents[1].amount.commodity,
+                      y.contents[0].amount.commodity.price.commodity)
+        lot = x.contents[0].amount.commodity
+        self.assertIs(lot, y.contents[0].amount.commodity)
+        self.assertEqual(lot, y.contents[1].amount.commodity)
+        self.assertIsNot(lot, y.contents[1].amount.commodity)
+        self.assertEqual(hash(lot), hash(tuple(lot)))
+        self.assertEqual(pickle.loads(pickle.dumps(lot)), lot)
+        self.assertNotIn("_hash", pickle.loads(pickle.dumps(lot)).__dict__)
+        # Streaming keeps only what the account tree would.
+        l = parser.Parser("test")
+        lines = []
+        for i in range(1, 20):
+            lines += [f"2022/01/{i:02d} payee {i}",
+                      f"  acc1  1 ABC {{EUR {i}}} [2022/01/{i:02d}]",
+                      "  acc2"]
+        self.assertEqual(len(list(l.iter_contents(lines))), 19)
+        self.assertEqual(set(l.journal._interned),
+                         {"acc1", "acc2", "ABC", "EUR"})
@@ -0,0 +1,36 @@
+import contextlib
+import io
+import unittest
+from decimal import Decimal
+
+import uledger3.parser as parser
+from uledger3.parser import Amount, Posting
+import uledger3.ledger as ledger
+from uledger3.printing import print_account_balance, print_account_tree
+
+class TestPrinting(unittest.TestCase):
+
+    def test_print_approximate(self):
+        p = parser.Parser("test")
+        p.parse_lines(["commodity EUR", "  format EUR 1,000.00"])
+        fmt = p.journal.get_commodity_format
+        trees = [ledger.Account("root"),
+                 ledger.Account("root", approximate=True)]
+        for x in trees:
+            for i in range(3):
+                x.apply(Posting("A:B", Amount(Decimal("0.10"), "EUR")))
+                x.apply(Posting("A:C", Amount(Decimal("-0.20"), "EUR")))
+            x.apply(Posting("D", Amount(Decimal("1.00"), "EUR")))
+        self.assertNotEqual(trees[1]["A:B"].balance["EUR"], 0.3)
+        outputs = []
+        for x in trees:
+            f = io.StringIO()
+            with contextlib.redirect_stdout(f):
+                print_account_balance(x, fmt)
+                print_account_tree(x, fmt, commodity="EUR")
+            outputs.append(f.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("EUR 0.30    B", outputs[1])
+        self.assertEqual(ledger.to_decimal(-0.001, 2), Decimal("0.00"))
+        self.assertEqual(str(ledger.to_decimal(0.1 + 0.2, 2)), "0.30")
+        self.assertEqual(ledger.to_decimal(0.1), Decimal("0.1"))
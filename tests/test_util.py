@@ -1,5 +1,8 @@
 import unittest
-from datetime import datetime
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 import uledger3.parser as parser
@@ -7,7 +10,8 @@ from uledger3.parser import Amount, Lot, Transaction, \
     Posting, Position, Journal, Entity
 import uledger3.ledger as ledger
 from uledger3.ledger import Account, Balance
-from uledger3.util import transform_account
+from uledger3.util import transform_account, read_journal, \
+    stream_journal, apply_journal, JournalLines, BalanceHistory
 
 class TestParser(unittest.TestCase):
 
@@ -37,3 +41,362 @@ class TestParser(unittest.TestCase):
         self.assertEqual(b["A:B"].balance["JPY"], Decimal("13.5"))
         self.assertEqual(b["A:B"].balance["ABC"], 0)
         self.assertEqual(b["A:B:X"].balance["ABC"], -6)
+
+        c = ledger.Account("root", deferred=True)
+        c.apply(Posting("A:B:C", Amount(Decimal("6"),   "JPY")))
+        c.apply(Posting("A:B:D", Amount(Decimal("7"),   "JPY")))
+        c.apply(Posting("A:B",   Amount(Decimal("14"),  "JPY")))
+        c.apply(Posting("A:B",   Amount(Decimal("12"),  "ABC")))
+        c.apply(Posting("A:B:X", Amount(Decimal("-12"), "ABC")))
+        d = ledger.Account("root")
+        transform_account(c, d, div2)
+        for i in ["A", "A:B", "A:B:C", "A:B:X"]:
+            self.assertEqual(b[i].balance, d[i].balance)
+        self.assertEqual(c["A:B"].balance_excluding_children()["JPY"], 14)
+
+        # The transformer may change the balance it is given.
+        def double(b: Balance, n: str) -> Balance:
+            for i in b:
+                b[i] *= 2
+            return b
+
+        for deferred in [False, True]:
+            c = ledger.Account("root", deferred=deferred)
+            c.apply(Posting("A:B", Amount(Decimal("5"), "JPY")))
+            c.apply(Posting("A", Amount(Decimal("1"), "JPY")))
+            d = ledger.Account("root")
+            transform_account(c, d, double)
+            self.assertEqual(c["A:B"].balance["JPY"], 5)
+            self.assertEqual(c["A"].balance["JPY"], 6)
+            self.assertEqual(d["A"].balance["JPY"], 12)
+
+    def test_transform_account_approximate(self):
+        a = ledger.Account("root", approximate=True)
+        for i in range(10):
+            a.apply(Posting("A:B", Amount(Decimal("0.1"), "JPY")))
+            a.apply(Posting("A", Amount(Decimal("0.2"), "JPY")))
+
+        def div2(b: Balance, n: str) -> Balance:
+            b_new = ledger.ApproximateBalance()
+            for i in b:
+                b_new.add(i, b[i] / 2, b.error(i) / 2)
+            return b_new
+
+        for independent in (False, True):
+            b = ledger.Account("root", approximate=True)
+            transform_account(a, b, div2, independent)
+            for name, exact in [("A", "1.5"), ("A:B", "0.5")]:
+                x = b[name].balance
+                self.assertGreater(x.error("JPY"), 0)
+                self.assertLessEqual(abs(Decimal(x["JPY"]) - Decimal(exact)),
+                                     Decimal(x.error("JPY")))
+            x = b["A"].balance_excluding_children()
+            self.assertLessEqual(abs(Decimal(x["JPY"]) - 1),
+                                 Decimal(x.error("JPY")))
+
+        x = a["A"].balance_excluding_children()
+        self.assertLessEqual(abs(Decimal(x["JPY"]) - 2),
+                             Decimal(x.error("JPY")))
+        self.assertGreaterEqual(x.error("JPY"),
+                                a["A"].balance.error("JPY") +
+                                a["A:B"].balance.error("JPY"))
+
+    def test_read_journal_parallel(self):
+        lines = [
+            "commodity EUR",
+            "  format EUR 1,000.00",
+            "",
+            "account Assets:Bank",
+            "  alias bank",
+            "",
+            "2021/11/03 payee",
+            "  bank  EUR 15",
+            "  Income",
+            "",
+            "commodity USD",
+            "  default",
+            "",
+            "2021/11/04 payee",
+            "  bank  12.125",
+            "  Income",
+            "",
+            "P 2021/11/05 EUR USD 1.5",
+            "",
+            "2021/11/06 payee",
+            "  bank  EUR 1,000",
+            "  Income",
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.ledger")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            journal, x = read_journal(path, pedantic=False)
+            parallel, y = read_journal(path, pedantic=False, jobs=2)
+            self.assertEqual(x, y)
+            self.assertEqual(len(parallel.contents), len(journal.contents))
+            txn = parallel.contents[-1]
+            self.assertEqual(txn.span.start, Position(20, 0))
+            self.assertEqual(txn.contents[0].account, "Assets:Bank")
+            # Entities parsed by different workers share strings again.
+            first = parallel.contents[4]
+            self.assertIs(first.contents[0].account, txn.contents[0].account)
+            self.assertIs(first.contents[1].account, txn.contents[1].account)
+            self.assertIs(first.contents[0].amount.commodity,
+                          txn.contents[0].amount.commodity)
+            self.assertEqual(parallel.contents[8].contents[0].amount,
+                             Amount(Decimal("12.125"), "USD"))
+            self.assertEqual(parallel.default_commodity, "USD")
+            self.assertEqual(parallel.account_aliases, {"bank": "Assets:Bank"})
+            self.assertEqual(parallel.inferred_commodity_formats,
+                             journal.inferred_commodity_formats)
+            self.assertEqual(parallel.get_commodity_format("USD").precision, 3)
+            with self.assertRaises(parser.ParseError) as e:
+                read_journal(path, jobs=2)
+            self.assertIn("Account 'Income' not declared\nline: 9, column: 2",
+                          str(e.exception))
+
+    def test_apply_journal_stream(self):
+        lines = [
+            "2021/11/03 payee",
+            "  A:B  EUR 15",
+            "  A:C  EUR -3",
+            "  Income",
+            "2021/11/04 payee",
+            "  A:B  USD 12",
+            "  Income",
+            "P 2021/11/05 EUR USD 1.5",
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.ledger")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            journal, _ = read_journal(path, pedantic=False)
+            a = Account("root")
+            apply_journal(journal, a)
+            journal, entities = stream_journal(path, pedantic=False)
+            b = Account("root")
+            apply_journal(entities, b)
+            self.assertEqual(journal.contents, [])
+            self.assertEqual(journal.get_commodity_format("USD").precision, 1)
+            for i in ["A", "A:B", "A:C", "Income"]:
+                self.assertEqual(a[i].balance, b[i].balance)
+            self.assertEqual(b["A"].balance["EUR"], Decimal("12"))
+
+    def test_apply_journal_parallel(self):
+        r = random.Random(0)
+        lines = []
+        for i in range(100):
+            lines.append("2021/11/03 payee")
+            lines.append(f"  A:{r.choice(['B', 'C'])}  "
+                         f"EUR {r.randint(-9, 9)}.5")
+            lines.append(f"  {r.choice(['(V)', 'E'])}  EUR -1")
+            lines.append(f"  D  EUR 1  = EUR {i + 1}")
+            lines.append("  A")
+        p = parser.Parser("test")
+        p.parse_lines(lines)
+        for real in [False, True]:
+            b = Account("root", fixed_point=True)
+            apply_journal(p.journal, b, real, assertions=True, jobs=3)
+            a = Account("root")
+            apply_journal(p.journal, a, real, assertions=True)
+            self.assertEqual(a.balance, b.balance)
+            for i in ["A", "A:B", "A:C", "D", "E", "V"]:
+                self.assertEqual(a[i].balance, b[i].balance)
+        p.journal.contents[80].contents[2].assertion = Amount(
+            Decimal(80), "EUR")
+        with self.assertRaises(ledger.BalanceError):
+            apply_journal(p.journal, Account("root"), assertions=True, jobs=3)
+        # The first error is reported, whichever worker finds it.
+        p = parser.Parser("test")
+        p.parse_lines(["2021/11/03 payee", "  A  EUR 1 = EUR 5", "  B",
+                       "2021/11/04 payee", "  A  EUR 1", "  B  EUR 1",
+                       "2021/11/05 payee", "  A  EUR 1", "  B",
+                       "2021/11/06 payee", "  A  EUR 1", "  B"])
+        for jobs in [1, 2]:
+            a = Account("root")
+            with self.assertRaises(ledger.BalanceError) as e:
+                apply_journal(p.journal, a, assertions=True, jobs=jobs)
+            self.assertIn("Balance assertion failed", str(e.exception))
+        p.journal.contents[0].contents[0].assertion = None
+        for jobs in [1, 2]:
+            a = Account("root")
+            with self.assertRaises(ledger.BalanceError) as e:
+                apply_journal(p.journal, a, assertions=True, jobs=jobs)
+            self.assertIn("unbalanced", str(e.exception))
+            self.assertEqual(a["A"].balance["EUR"], 1)
+
+    def test_apply_journal_approximate_assertions(self):
+        lines = []
+        for i in range(1, 30):
+            lines.append("2021/11/03 payee")
+            lines.append(f"  A  EUR 0.10 = EUR {i / 10:.2f}")
+            lines.append("  B")
+        lines.append("2021/11/04 payee")
+        lines.append("  A  EUR 0.20 = EUR 3.10")
+        lines.append("  B")
+        p = parser.Parser("test")
+        p.parse_lines(lines)
+        for jobs in [1, 2]:
+            a = Account("root", approximate=True)
+            apply_journal(p.journal, a, assertions=True, jobs=jobs)
+            self.assertNotEqual(Decimal(a["A"].balance["EUR"]),
+                                Decimal("3.1"))
+        p.journal.contents[-1].contents[0].assertion = Amount(
+            Decimal("3.11"), "EUR")
+        for jobs in [1, 2]:
+            with self.assertRaises(ledger.BalanceError):
+                apply_journal(p.journal, Account("root", approximate=True),
+                              assertions=True, jobs=jobs)
+
+    def test_read_journal_cache(self):
+        lines = [
+            "commodity EUR",
+            "  default",
+            "2021/11/03 payee",
+            "  A:B  15",
+            "  Income",
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.ledger")
+            cache = os.path.join(d, "cache")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            journal, x = read_journal(path, pedantic=False, cache=cache)
+            self.assertEqual(len(os.listdir(cache)), 1)
+            cached, y = read_journal(path, pedantic=False, cache=cache)
+            self.assertEqual(x, y)
+            self.assertEqual(cached.default_commodity, "EUR")
+            self.assertEqual(cached.contents[1].contents[0].amount,
+                             Amount(Decimal("15"), "EUR"))
+            self.assertEqual(cached.contents[1].span.end, Position(5, 7))
+            self.assertEqual(cached.inferred_commodity_formats,
+                             journal.inferred_commodity_formats)
+            _, entities = stream_journal(path, pedantic=False, cache=cache)
+            self.assertEqual(len(list(entities)), 2)
+            with open(path, "a") as f:
+                f.write("  A:C  5\n")
+            journal, _ = read_journal(path, pedantic=False, cache=cache)
+            self.assertEqual(len(journal.contents[1].contents), 3)
+            with self.assertRaises(parser.ParseError):
+                read_journal(path, cache=cache)
+            self.assertEqual(len(os.listdir(cache)), 1)
+
+    def test_read_journal_incremental(self):
+        lines = [
+            "commodity EUR",
+            "  default",
+            "",
+            "2021/11/03 payee",
+            "  A:B  15",
+            "  Income",
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.ledger")
+            cache = os.path.join(d, "cache")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            read_journal(path, pedantic=False, cache=cache)
+            more = [
+                "  A:C  5",
+                "2021/11/04 payee",
+                "  A:B  1,000.5",
+                "  Income",
+            ]
+            with open(path, "a") as f:
+                f.write("\n".join(more) + "\n")
+            journal, _ = read_journal(path, pedantic=False, cache=cache)
+            expected, _ = read_journal(path, pedantic=False, cache="")
+            self.assertEqual(len(journal.contents), 4)
+            self.assertEqual(len(journal.contents[2].contents), 3)
+            self.assertEqual(journal.contents[3].span.start, Position(8, 0))
+            self.assertEqual(journal.inferred_commodity_formats,
+                             expected.inferred_commodity_formats)
+            # Edits before the end of the snapshot mean a full parse.
+            with open(path, "w") as f:
+                f.write("\n".join(["commodity USD"] + lines[1:] + more))
+            journal, _ = read_journal(path, pedantic=False, cache=cache)
+            self.assertEqual(journal.default_commodity, "USD")
+            self.assertEqual(journal.contents[2].contents[0].amount,
+                             Amount(Decimal("15"), "USD"))
+            # Deleting the last entry cuts the file back to the snapshot.
+            with open(path, "w") as f:
+                f.write("\n".join(lines + more[1:]) + "\n")
+            read_journal(path, pedantic=False, cache=cache)
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            for _ in range(2):
+                journal, _ = read_journal(path, pedantic=False, cache=cache)
+                self.assertEqual(
+                    [i.span.start.line for i in journal.contents
+                     if isinstance(i, Transaction)], [4])
+
+    def test_journal_lines(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "test.ledger")
+            with open(path, "w") as f:
+                f.write("2021/11/03 payee  \n  A:B  15\r\n\n  Income")
+            lines = JournalLines(path)
+            self.assertEqual(lines[1], "  A:B  15")
+            self.assertEqual(lines[-1], "  Income")
+            self.assertEqual(len(lines), 4)
+            self.assertEqual(lines[:2], ["2021/11/03 payee", "  A:B  15"])
+            self.assertEqual(lines, ["2021/11/03 payee", "  A:B  15", "",
+                                     "  Income"])
+            with self.assertRaises(IndexError):
+                lines[4]
+            txn = Transaction(datetime(2021, 11, 3), None, "payee")
+            txn.span = parser.Span(Position(2, 2), Position(2, 8))
+            e = ledger.LedgerError("Error.", txn, JournalLines(path))
+            self.assertEqual(str(e),
+                             "Error.\nline: 2, column: 2\n  A:B  15\n  ^")
+            with open(path, "w") as f:
+                pass
+            self.assertFalse(JournalLines(path))
+            self.assertEqual(list(JournalLines(path)), [])
+
+    def test_balance_history(self):
+        r = random.Random(0)
+        lines = []
+        for i in range(200):
+            day = datetime(2021, 1, 1) + timedelta(days=r.randint(0, 100))
+            lines.append(f"{day:%Y/%m/%d} payee")
+            lines.append(f"  {r.choice(['A:B', 'A:C', 'D'])}  "
+                         f"{r.choice(['EUR', 'USD'])} {r.randint(-9, 9)}.5")
+            lines.append(f"  {r.choice(['(V)', 'E'])}  EUR 1")
+            lines.append("  A")
+        p = parser.Parser("test")
+        p.parse_lines(lines)
+        transactions = p.journal.contents
+        histories = [BalanceHistory(p.journal, every=7),
+                     BalanceHistory(transactions, real=True, every=0,
+                                    monthly=True)]
+        dates = [None, datetime(2020, 1, 1), datetime(2021, 1, 1)] + \
+            sorted(datetime(2021, 1, 1) + timedelta(days=r.randint(0, 110))
+                   for _ in range(20))
+        for history, real in zip(histories, [False, True]):
+            for begin, end in zip(dates, dates[1:] + [None]):
+                a = history.balance(end)
+                b = Account("root")
+                apply_journal([x for x in transactions
+                               if end is None or x.date <= end], b, real)
+                self.assertEqual(a.balance, b.balance)
+                for i in ["A", "A:B", "A:C", "D", "E", "V"]:
+                    self.assertEqual(a[i].balance, b[i].balance)
+                a = history.change(begin, end)
+                b = Account("root")
+                apply_journal([x for x in transactions
+                               if (begin is None or x.date > begin) and
+                               (end is None or x.date <= end)], b, real)
+                for i in ["A", "A:B", "D", "E", "V"]:
+                    self.assertEqual(a[i].balance, b[i].balance)
+        self.assertEqual(BalanceHistory([]).balance(None).balance, 0)
+        # Balances not changed between checkpoints are shared by them.
+        p = parser.Parser("test")
+        p.parse_lines(["2021/01/01 payee", "  A  EUR 1", "  B",
+                       "2021/01/02 payee", "  C  EUR 1", "  B",
+                       "2021/01/03 payee", "  C  EUR 1", "  B"])
+        history = BalanceHistory(p.journal, every=1)
+        first, second = history._checkpoints[1:]
+        self.assertIs(first["A"], second["A"])
+        self.assertEqual(history.balance(None)["B"].balance["EUR"], -3)
+        self.assertEqual(first["B"]["EUR"], -1)
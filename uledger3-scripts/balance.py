@@ -6,8 +6,8 @@ from decimal import Decimal
 
 from uledger3.printing import print_account_balance, \
     print_account_tree
-from uledger3.ledger import Account, Balance
-from uledger3.util import read_journal, apply_journal
+from uledger3.ledger import Account, Balance, to_decimal
+from uledger3.util import read_journal, apply_journal, stream_journal
 from uledger3.exchange import Exchange
 from uledger3.parser import Amount, Lot, Transaction, \
     Posting, Position, Journal, Entity, PriceDecl
@@ -36,66 +36,59 @@ def parse_args():
     argparser.add_argument("--account", type=str,
                            default="",
                            help="Account to display")
+    argparser.add_argument("--jobs", type=int,
+                           default=1,
+                           help="Number of processes used for parsing "
+                                "and applying transactions")
     return argparser.parse_args()
 
 def exchanger(exchange: Exchange, commodity: str, b: Balance) -> Balance:
-    b_new = Balance()
-    for i in b:
-        if isinstance(i, Lot):
-            x = exchange.get_price(i.date,
-                                   i.price.commodity,
-                                   commodity)
-            if x:
-                b_new += Amount(
-                    b[i],
-                    Lot(i.commodity, i.date,
-                        Amount(i.price.quantity * x, commodity))
-                )
-            else:
-                b_new += Amount(b[i], i)
-        else:
-            x = exchange.get_price(None, i, commodity)
-            if x:
-                b_new += Amount(b[i] * x, commodity)
-            else:
-                b_new += Amount(b[i], i)
-    return b_new
+    return exchange.convert_balance(b, commodity)
 
 def quantizer(format_function: Callable, b: Balance) -> Balance:
     b_new = Balance()
     for i in b:
         if isinstance(i, Lot):
-            b_new[i] = b[i]
+            b_new[i] = to_decimal(b[i])
         else:
             fmt = format_function(i)
             if not fmt: continue
             precision = fmt.precision
-            q = Decimal(10) ** -precision # 2 places --> '0.01'
-            v = b[i].quantize(q)
+            v = to_decimal(b[i], precision)
             #print(f"Quantized {b[i]} to {v}.")
             b_new[i] = v
     return b_new
 
+def collect_prices(exchange: Exchange, entities):
+    """Add price declarations to the exchange as entities stream past."""
+    for i in entities:
+        if isinstance(i, PriceDecl):
+            exchange.add_price(i.date, i.commodity,
+                               i.price.commodity, i.price.quantity)
+        yield i
+
 def main():
     args = parse_args()
-    journal, lines = read_journal(args.database)
+
+    exchange = Exchange()
+    if args.exchange and args.prices:
+        _, prices = stream_journal(args.prices)
+        exchange.load_prices(
+            (i.date, i.commodity, i.price.commodity, i.price.quantity)
+            for i in prices if isinstance(i, PriceDecl))
+
+    if args.jobs > 1:
+        journal, lines = read_journal(args.database, jobs=args.jobs)
+        entities = journal.contents
+    else:
+        journal, entities = stream_journal(args.database)
+    if args.exchange:
+        entities = collect_prices(exchange, entities)
 
     root = Account("root")
-    apply_journal(journal, root, args.real, args.lots)
+    apply_journal(entities, root, args.real, args.lots, jobs=args.jobs)
 
     if args.exchange:
-        prices = None
-        if args.prices:
-            prices, _ = read_journal(args.prices)
-            prices = prices.contents
-        exchange = Exchange()
-        for i in (prices, journal.contents):
-            for price in i:
-                if not isinstance(price, PriceDecl):
-                    continue
-                exchange.add_price(
-                    price.date, price.commodity,
-                    price.price.commodity, price.price.quantity)
         exchanged = Account("root")
         commodity = args.exchange
         transform_account(root, exchanged,
@@ -2,6 +2,7 @@
 
 import argparse
 from decimal import Decimal
+from typing import Sequence
 
 import uledger3.parser as parser
 import uledger3.ledger as ledger
@@ -11,7 +12,7 @@ from uledger3.ledger import Account
 from uledger3.util import read_journal
 from uledger3.util import apply_transaction
 
-def check_journal(journal: Journal, lines: list[str]):
+def check_journal(journal: Journal, lines: Sequence[str]):
     last_date = None
     root = Account("root")
     for i in journal.contents:
@@ -53,7 +54,7 @@ def _read_exchange_rate_comment(comment: str) -> tuple[str, Amount] | None:
     amount = amount[0]
     return (commodity, amount)
 
-def check_trading_equity(txn: Transaction, lines: list[str] | None = None):
+def check_trading_equity(txn: Transaction, lines: Sequence[str] | None = None):
     ledger.unelide_transaction(txn, lines)
     a = Account("root")
     exchange_rates: dict[str, Amount] = {}
@@ -0,0 +1,208 @@
+import gc
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from typing import NamedTuple, Iterable, Iterator
+
+from uledger3.parser import Journal, Entity
+
+# Bump whenever the pickled form of the parser's classes changes.
+_VERSION = 3
+_BATCH_SIZE = 4096
+
+class SnapshotState(NamedTuple):
+    """How far a snapshot reaches into its journal file.
+
+    The snapshot holds every top-level item before byte offset, which is
+    the start of a line beginning a top-level item. prefix_digest is the
+    hash of the bytes before offset, line_number the number of lines
+    there, and journal the declarations made in them.
+    """
+    offset: int
+    prefix_digest: str
+    line_number: int
+    journal: tuple
+
+def prefix_digests(database: str, offsets: Iterable[int]) -> dict[int, str]:
+    """Hash the first offset bytes of a file, for each offset in one pass.
+
+    Offsets past the end of the file are left out of the result.
+    """
+    digest = hashlib.sha256()
+    result = {}
+    position = 0
+    with open(database, "rb") as f:
+        for offset in sorted(set(offsets)):
+            while position < offset:
+                block = f.read(min(offset - position, 1 << 20))
+                if not block:
+                    return result
+                digest.update(block)
+                position += len(block)
+            result[offset] = digest.copy().hexdigest()
+    return result
+
+def starts_item(line: bytes) -> bool:
+    """Whether a raw line begins a top-level item (or is blank)."""
+    line = line.decode(errors="replace").rstrip()
+    return not line or not line[0].isspace()
+
+def last_boundary(database: str) -> int:
+    """Byte offset of the last line that begins a top-level item."""
+    with open(database, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        start = size
+        while start > 0:
+            start = max(start - (1 << 16), 0)
+            f.seek(start)
+            data = f.read(size - start)
+            # A final newline ends the last line rather than starting one.
+            end = len(data) - 1 if data.endswith(b"\n") else len(data)
+            while True:
+                i = data.rfind(b"\n", 0, end)
+                if i < 0 and start > 0:
+                    break
+                if starts_item(data[i + 1:end]):
+                    return start + i + 1
+                if i < 0:
+                    return 0
+                end = i
+    return 0
+
+def snapshot_path(directory: str, database: str, pedantic: bool) -> str:
+    database = os.path.abspath(database)
+    key = hashlib.sha256(f"{database}:{pedantic}".encode()).hexdigest()
+    return os.path.join(directory,
+                        f"{os.path.basename(database)}.{key[:16]}.cache")
+
+def batches(items: Iterable) -> Iterator[list]:
+    batch = []
+    for i in items:
+        batch.append(i)
+        if len(batch) >= _BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def journal_state(journal: Journal) -> tuple:
+    return (journal.default_commodity,
+            journal.account_aliases,
+            journal.declared_commodities,
+            journal.declared_accounts,
+            journal.declared_commodity_formats,
+            journal.inferred_commodity_formats)
+
+def restore_journal_state(journal: Journal, state: tuple) -> None:
+    (journal.default_commodity,
+     journal.account_aliases,
+     journal.declared_commodities,
+     journal.declared_accounts,
+     journal.declared_commodity_formats,
+     journal.inferred_commodity_formats) = state
+
+def _load_without_gc(f):
+    # Unpickling allocates many objects and none of them form reference
+    # cycles; letting the cyclic collector run repeatedly over the growing
+    # heap makes loading several times slower.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.load(f)
+    finally:
+        if enabled:
+            gc.enable()
+
+# A snapshot file is laid out as
+#
+#   version | contents batch | ... | state | trailer
+#
+# where the trailer holds the offset of the state. Extending a snapshot
+# copies everything before the state and appends new batches, a new state
+# and a new trailer.
+_TRAILER_SIZE = 8
+
+class SnapshotReader():
+    """Iterate over the contents of a parsed-journal snapshot.
+
+    state is None if there is no usable snapshot at path.
+    """
+    def __init__(self, path: str):
+        self.state: SnapshotState | None = None
+        self._file = None
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return
+        try:
+            if pickle.load(f) != _VERSION:
+                raise ValueError(path)
+            self._begin = f.tell()
+            f.seek(-_TRAILER_SIZE, os.SEEK_END)
+            self._end = int.from_bytes(f.read(_TRAILER_SIZE), "little")
+            f.seek(self._end)
+            self.state = SnapshotState(*pickle.load(f))
+        except Exception:
+            f.close()
+            self.state = None
+            return
+        self._file = f
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+
+    def __iter__(self) -> Iterator[str | Entity]:
+        f = self._file
+        f.seek(self._begin)
+        while f.tell() < self._end:
+            yield from _load_without_gc(f)
+
+class SnapshotWriter():
+    """Write a new snapshot, or extend base with more items.
+
+    Nothing replaces the snapshot at path until commit().
+    """
+    def __init__(self, path: str, base: SnapshotReader | None = None):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, self._temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        self._path = path
+        self._file = os.fdopen(fd, "wb")
+        if base:
+            base._file.seek(0)
+            shutil.copyfileobj(base._file, self._file)
+            self._file.truncate(base._end)
+            self._file.seek(base._end)
+        else:
+            self._dump(_VERSION)
+
+    def _dump(self, value) -> None:
+        pickle.dump(value, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def write(self, items: list[str | Entity]) -> None:
+        """Write a batch of top-level items.
+
+        Items are pickled immediately, so they may be modified (e.g.
+        unelided) once this returns.
+        """
+        self._dump(items)
+
+    def write_state(self, state: SnapshotState) -> None:
+        """Record state after the last batch; nothing is written after it."""
+        end = self._file.tell()
+        self._dump(tuple(state))
+        self._file.write(end.to_bytes(_TRAILER_SIZE, "little"))
+
+    def commit(self) -> None:
+        self._file.close()
+        os.replace(self._temp, self._path)
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self._temp)
+        except OSError:
+            pass
@@ -1,62 +1,125 @@
-from datetime import datetime
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from decimal import Decimal
+from typing import Iterable, NamedTuple
+import bisect
+import functools
+import heapq
 import logging
+import operator
+import sys
+
+from uledger3.ledger import Balance
+from uledger3.parser import Amount, Lot
 
 PriceEntry_t = tuple[datetime, Decimal]
 
-class Queue:
-    def __init__(self):
-        self.items = []
+class ApproximatePrice(NamedTuple):
+    price: float
+    # A bound on the absolute error of the price.
+    error: float
 
-    def is_empty(self):
-        return self.size() == 0
+def _approximate_product(factors: list[Decimal]) -> ApproximatePrice:
+    x = 1.0
+    for i in factors:
+        x *= float(i)
+    # Each factor is rounded once when converted and once when multiplied,
+    # and n roundings are within n*u/(1 - n*u) relative error.
+    n = 2 * len(factors) * sys.float_info.epsilon / 2
+    return ApproximatePrice(x, n / (1 - n) * abs(x))
 
-    def enqueue(self, item):
-        self.items.insert(0, item)
+_MICROSECONDS_PER_DAY = 86400 * 10**6
 
-    def dequeue(self):
-        return self.items.pop()
+@functools.lru_cache(maxsize=1 << 16)
+def _date_key(date: datetime) -> int:
+    """The date as an integer count of microseconds, which sorts the same
+    way and packs into an array."""
+    seconds = (date.hour * 60 + date.minute) * 60 + date.second
+    return date.toordinal() * _MICROSECONDS_PER_DAY + \
+        seconds * 10**6 + date.microsecond
 
-    def size(self):
-        return len(self.items)
+def _key_date(key: int) -> datetime:
+    days, microseconds = divmod(key, _MICROSECONDS_PER_DAY)
+    return datetime.fromordinal(days) + timedelta(microseconds=microseconds)
 
-def _search_date(pricelist: list[PriceEntry_t], date: datetime) \
-    -> PriceEntry_t | None:
-    if not len(pricelist):
-        return None
+class _PriceSeries():
+    """The prices between two commodities, as columns of date keys and
+    quantities in ascending order of dates.
 
-    if not date:
-        return pricelist[-1]
+    Both commodities share the series. Each price is kept once, as given,
+    and flagged if it was given in the second commodity rather than the
+    first. Reading it the other way divides it out then, and the result
+    is kept if inverses are cached.
 
-    low = 0
-    high = len(pricelist) - 1
+    Prices added out of order are sorted when the series is next read.
+    Prices on the same date stay in the order they were added, and the
+    last of them is used.
+    """
+    __slots__ = ("first", "keys", "quantities", "inverted", "_inverses",
+                 "_sorted")
 
-    while (high > low):
-        mid = (low + high) // 2
-        mid_date = pricelist[mid][0]
-        if mid_date > date:
-            high = mid
-        elif mid == low:
-            high_date = pricelist[high][0]
-            if high_date <= date:
-                low = high
-            else:
-                high -= 1
-        else:
-            low = mid
+    def __init__(self, first: str, cache_inverses: bool = True):
+        self.first = first
+        self.keys = array("q")
+        self.quantities: list[Decimal] = []
+        self.inverted = bytearray()
+        self._inverses: dict[int, Decimal] | None = \
+            {} if cache_inverses else None
+        self._sorted = True
+
+    def append(self, key: int, quantity: Decimal, src_cmdty: str):
+        if self.keys and key < self.keys[-1]:
+            self._sorted = False
+        self.keys.append(key)
+        self.quantities.append(quantity)
+        self.inverted.append(src_cmdty != self.first)
 
-    found = pricelist[low]
-    if date >= found[0]:
-        return found
-    else:
-        return None
+    def extend(self, keys: list[int], quantities: list[Decimal],
+               src_cmdties: list[str]):
+        if self.keys and keys and keys[0] < self.keys[-1]:
+            self._sorted = False
+        elif any(a > b for a, b in zip(keys, keys[1:])):
+            self._sorted = False
+        self.keys.extend(keys)
+        self.quantities.extend(quantities)
+        self.inverted.extend(i != self.first for i in src_cmdties)
+
+    def sort(self):
+        if self._sorted: return
+        x = sorted(zip(self.keys, self.quantities, self.inverted),
+                   key=operator.itemgetter(0))
+        self.keys = array("q", [i[0] for i in x])
+        self.quantities = [i[1] for i in x]
+        self.inverted = bytearray(i[2] for i in x)
+        if self._inverses:
+            self._inverses.clear()
+        self._sorted = True
+
+    def index(self, date: datetime | None, lo: int = 0) -> int:
+        """The index of the price used at the date, or -1 if there is none.
+        The latest price is used for no date."""
+        self.sort()
+        if date is None:
+            return len(self.keys) - 1
+        return bisect.bisect_right(self.keys, _date_key(date), lo) - 1
+
+    def quantity(self, i: int, src_cmdty: str) -> Decimal:
+        """The price at the index of src_cmdty in the other commodity."""
+        if (src_cmdty == self.first) != self.inverted[i]:
+            return self.quantities[i]
+        if self._inverses is None:
+            return 1/self.quantities[i]
+        x = self._inverses.get(i)
+        if x is None:
+            x = self._inverses[i] = 1/self.quantities[i]
+        return x
 
 class CommodityNode():
 
     def __init__(self, commodity):
         self._commodity = commodity
-        self._adjacent: dict[str, list[PriceEntry_t]] = dict()
-        self._sorted: dict[str, bool] = dict()
+        self._adjacent: dict[str, _PriceSeries] = dict()
 
     def adjacent(self, commodity=None):
         if not commodity:
@@ -64,88 +127,306 @@ class CommodityNode():
         else:
             return commodity in self._adjacent
 
-    def add_price(self, date: datetime, commodity: str, quantity: Decimal):
-        if commodity in self._adjacent:
-            self._adjacent[commodity].append((date, quantity))
-            self._sorted[commodity] = False
-        else:
-            self._adjacent[commodity] = [(date, quantity)]
-            self._sorted[commodity] = True
+    def connect(self, commodity: str, series: _PriceSeries):
+        self._adjacent[commodity] = series
 
-    def _sort(self, commodity):
-        if self._sorted[commodity]: return
-        # Sort in ascending order of dates.
-        self._adjacent[commodity].sort(key=lambda x: x[0])
-        self._sorted[commodity] = True
+    def first_date(self, commodity: str) -> datetime:
+        series = self._adjacent[commodity]
+        series.sort()
+        return _key_date(series.keys[0])
+
+    def prices(self, commodity: str) -> _PriceSeries:
+        return self._adjacent[commodity]
 
     def get_price(self, date: datetime, commodity: str) -> PriceEntry_t | None:
-        if commodity not in self._adjacent:
+        series = self._adjacent.get(commodity)
+        if series is None:
+            return None
+        i = series.index(date)
+        if i < 0:
             return None
-        self._sort(commodity)
-        return _search_date(self._adjacent[commodity], date)
+        return (_key_date(series.keys[i]),
+                series.quantity(i, self._commodity))
+
+class _PathTree():
+    """The paths from every commodity to one commodity.
+
+    Each commodity reached maps to the next one on its path. The search
+    starts at the target and only goes as far as lookups need. It is
+    breadth first, so paths have the fewest conversions, or with freshest,
+    the cost of a conversion is how old its price is at the date, and
+    paths have the freshest prices, then the fewest conversions.
+
+    Breadth first paths only depend on which prices exist at the date, so
+    the tree is the same for all dates until the next conversion is first
+    priced, and any of them may be looked up in it.
+    """
+    def __init__(self, commodities: dict[str, "CommodityNode"],
+                 date: datetime | None, target: str, freshest: bool = False,
+                 latest: datetime | None = None):
+        self._commodities = commodities
+        self._date = date
+        self._parents: dict[str, str | None] = {}
+        self._freshest = freshest
+        if freshest:
+            # Prices are as old as the date they are used at, or as the
+            # latest price for the latest prices.
+            self._now = _date_key(date or latest)
+            self._costs = {target: (0, 0)}
+            self._tentative: dict[str, str | None] = {target: None}
+            self._heap = [(0, 0, target)]
+        else:
+            self._parents[target] = None
+            self._queue = deque([target])
+
+    def path(self, cmdty: str) -> list[str] | None:
+        while cmdty not in self._parents:
+            if not self._expand():
+                return None
+        path = [cmdty]
+        while self._parents[cmdty] is not None:
+            cmdty = self._parents[cmdty]
+            path.append(cmdty)
+        return path
+
+    def factors(self, cmdty: str, date: datetime | None) \
+        -> tuple[Decimal, ...] | None:
+        path = self.path(cmdty)
+        if path is None:
+            return None
+        factors = []
+        for a, b in zip(path, path[1:]):
+            series = self._commodities[a].prices(b)
+            factors.append(series.quantity(series.index(date), a))
+        return tuple(factors)
+
+    def _expand(self) -> bool:
+        if self._freshest:
+            return self._expand_freshest()
+        if not self._queue:
+            return False
+        cmdty = self._queue.popleft()
+        for i in self._commodities[cmdty].adjacent():
+            if i in self._parents: continue
+            if self._commodities[i].prices(cmdty).index(self._date) < 0:
+                continue
+            self._parents[i] = cmdty
+            self._queue.append(i)
+        return True
+
+    def _expand_freshest(self) -> bool:
+        while self._heap:
+            age, hops, cmdty = heapq.heappop(self._heap)
+            # Only the first, cheapest, entry for a commodity counts.
+            if cmdty in self._parents: continue
+            self._parents[cmdty] = self._tentative.pop(cmdty)
+            for i in self._commodities[cmdty].adjacent():
+                if i in self._parents: continue
+                series = self._commodities[i].prices(cmdty)
+                j = series.index(self._date)
+                if j < 0: continue
+                cost = (age + (self._now - series.keys[j]), hops + 1)
+                if i in self._costs and self._costs[i] <= cost: continue
+                self._costs[i] = cost
+                self._tentative[i] = cmdty
+                heapq.heappush(self._heap, (*cost, i))
+            return True
+        return False
 
 class Exchange():
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 4096, tree_cache_size: int = 64,
+                 cache_inverses: bool = True):
         self._commodities: dict[str, CommodityNode] = dict()
         self._sorted: bool = True
+        self._latest: datetime | None = None
+        # The dates conversions are first priced at, in order.
+        self._epochs: list[datetime] | None = None
+        # The conversion factors found for recent (date, src, dst) lookups,
+        # or None where there was no path, least recently used first.
+        self._cache: OrderedDict[tuple, tuple[Decimal, ...] | None] = \
+            OrderedDict()
+        self._cache_size = cache_size
+        # The paths into recently used targets, likewise.
+        self._trees: OrderedDict[tuple, _PathTree] = OrderedDict()
+        self._tree_cache_size = tree_cache_size
+        self._cache_inverses = cache_inverses
+
+    def _forget_paths(self):
+        self._cache.clear()
+        self._trees.clear()
+        self._epochs = None
 
     def add_price(self, date: datetime, src_cmdty: str,
                   dst_cmdty: str, quantity: Decimal):
-        self._add_price(date, src_cmdty, dst_cmdty, quantity)
-        self._add_price(date, dst_cmdty, src_cmdty, 1/quantity)
+        self._forget_paths()
+        if self._latest is None or date > self._latest:
+            self._latest = date
+        self._series(src_cmdty, dst_cmdty).append(
+            _date_key(date), quantity, src_cmdty)
 
-    def _add_price(self, date: datetime, src_cmdty: str,
-                   dst_cmdty: str, quantity: Decimal):
-        if src_cmdty not in self._commodities:
-            self._commodities[src_cmdty] = CommodityNode(src_cmdty)
-        self._commodities[src_cmdty].add_price(date, dst_cmdty, quantity)
+    def load_prices(self,
+                    prices: Iterable[tuple[datetime, str, str, Decimal]]):
+        """Add many (date, src, dst, quantity) prices, as add_price does."""
+        self._forget_paths()
+        # The columns of each pair of commodities are built up and added in
+        # one go.
+        columns: dict[tuple[str, str], tuple[list, list, list]] = {}
+        last = None
+        for date, src_cmdty, dst_cmdty, quantity in prices:
+            if date != last:
+                key = _date_key(date)
+                last = date
+            if src_cmdty < dst_cmdty:
+                pair = (src_cmdty, dst_cmdty)
+            else:
+                pair = (dst_cmdty, src_cmdty)
+            column = columns.get(pair)
+            if column is None:
+                column = columns[pair] = ([], [], [])
+            column[0].append(key)
+            column[1].append(quantity)
+            column[2].append(src_cmdty)
+        for (a, b), (keys, quantities, src_cmdties) in columns.items():
+            self._series(a, b).extend(keys, quantities, src_cmdties)
+            latest = _key_date(max(keys))
+            if self._latest is None or latest > self._latest:
+                self._latest = latest
+
+    def _series(self, src_cmdty: str, dst_cmdty: str) -> _PriceSeries:
+        node = self._commodities.get(src_cmdty)
+        if node is None:
+            node = self._commodities[src_cmdty] = CommodityNode(src_cmdty)
+        if node.adjacent(dst_cmdty):
+            return node.prices(dst_cmdty)
+        series = _PriceSeries(src_cmdty, self._cache_inverses)
+        node.connect(dst_cmdty, series)
+        if dst_cmdty not in self._commodities:
+            self._commodities[dst_cmdty] = CommodityNode(dst_cmdty)
+        self._commodities[dst_cmdty].connect(src_cmdty, series)
+        return series
 
-    def get_price(self, date: datetime, src_cmdty: str, dst_cmdty: str) \
-        -> Decimal | None:
+    def get_price(self, date: datetime, src_cmdty: str, dst_cmdty: str,
+                  approximate: bool = False, freshest: bool = False) \
+        -> Decimal | ApproximatePrice | None:
+        """The price of src_cmdty in dst_cmdty at the date, converting
+        through other commodities if needed.
+
+        The path with the fewest conversions is used, or with freshest,
+        the one whose prices are the most recent.
+        """
         if not (src_cmdty or dst_cmdty):
             return None
-        if src_cmdty not in self._commodities:
+        key = (date, src_cmdty, dst_cmdty, freshest)
+        try:
+            factors = self._cache[key]
+            self._cache.move_to_end(key)
+        except KeyError:
+            factors = None
+            if src_cmdty in self._commodities and \
+                    dst_cmdty in self._commodities:
+                factors = self._path_tree(date, dst_cmdty, freshest) \
+                    .factors(src_cmdty, date)
+            if self._cache_size:
+                self._cache[key] = factors
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        if factors is None:
             return None
-        visited = set()
-        queue = Queue()
-
-        # The path starts with itself with a conversion factor of 1.
-        start = (src_cmdty, date, 1)
-        queue.enqueue([start])
-        # A path looks like:
-        # [(commodity, date, factor),
-        #  (commodity, date, factor),
-        #  ...]
-        #
-        # If a path is found, it is assigned to this variable.
-        found = None
-
-        debug = False
-
-        while queue.size():
-            path = queue.dequeue()
-            cmdty = path[-1][0]
-            if debug:
-                print(f"Visiting {cmdty}")
-            if cmdty == dst_cmdty:
-                found = path
-                break
-            visited.add(cmdty)
-            node = self._commodities[cmdty]
-            for i in node.adjacent():
-                if i in visited: continue
-                p = node.get_price(date, i)
-                if not p: continue
-                new_path = path.copy()
-                new_path.append((i, p[0], p[1]))
-                queue.enqueue(new_path)
-
-        if debug:
-            print(f"Found {found}")
-
-        if found:
+        if approximate:
+            return _approximate_product(factors)
+        x = 1
+        for i in factors:
+            x *= i
+        return x
+
+    def convert(self,
+                requests: Iterable[tuple[datetime | None, str, Decimal]],
+                dst_cmdty: str) -> list[Decimal | None]:
+        """Convert each (date, commodity, quantity) into dst_cmdty, or None
+        where there is no price.
+
+        The prices are those get_price would use, but they are read in
+        order of date, and each search of a conversion's prices starts where
+        the previous one for it ended.
+        """
+        requests = list(requests)
+        prices = self._get_prices([(d, c) for d, c, _ in requests],
+                                  dst_cmdty)
+        return [None if x is None else q * x
+                for (_, _, q), x in zip(requests, prices)]
+
+    def convert_balance(self, balance: Balance, dst_cmdty: str) -> Balance:
+        """Convert a balance into dst_cmdty where there are prices.
+
+        Commodities are converted at their latest prices. Lots keep their
+        commodity and date, and their price is converted at their date.
+        """
+        keys = list(balance)
+        prices = self._get_prices(
+            [(i.date, i.price.commodity) if isinstance(i, Lot) else (None, i)
+             for i in keys], dst_cmdty)
+        b_new = Balance()
+        for i, x in zip(keys, prices):
+            if not x:
+                b_new += Amount(balance[i], i)
+            elif isinstance(i, Lot):
+                b_new += Amount(balance[i], Lot(
+                    i.commodity, i.date,
+                    Amount(i.price.quantity * x, dst_cmdty)))
+            else:
+                b_new += Amount(balance[i] * x, dst_cmdty)
+        return b_new
+
+    def _get_prices(self, requests: list[tuple[datetime | None, str]],
+                    dst_cmdty: str) -> list[Decimal | None]:
+        order = sorted(range(len(requests)), key=lambda i: (
+            requests[i][0] is None, requests[i][0] or datetime.min))
+        result: list[Decimal | None] = [None] * len(requests)
+        if dst_cmdty not in self._commodities:
+            return result
+        # The index of the price used last for each conversion, which only
+        # moves forward as the dates do, so searches start from there.
+        cursors: dict[tuple[str, str], int] = {}
+        for i in order:
+            date, src_cmdty = requests[i]
+            if src_cmdty not in self._commodities:
+                continue
+            path = self._path_tree(date, dst_cmdty, False).path(src_cmdty)
+            if path is None:
+                continue
             x = 1
-            for i in found:
-                x *= i[2]
-            return x
+            for edge in zip(path, path[1:]):
+                series = self._commodities[edge[0]].prices(edge[1])
+                j = series.index(date, cursors.get(edge, 0))
+                cursors[edge] = j
+                x *= series.quantity(j, edge[0])
+            result[i] = x
+        return result
+
+    def _path_tree(self, date: datetime | None, dst_cmdty: str,
+                   freshest: bool) -> _PathTree:
+        if freshest:
+            key = (date, dst_cmdty, freshest)
+        else:
+            # Trees are shared by all dates between the same two epochs.
+            if self._epochs is None:
+                self._epochs = sorted({
+                    x.first_date(i) for x in self._commodities.values()
+                    for i in x.adjacent()})
+            epoch = len(self._epochs)
+            if date is not None:
+                epoch = bisect.bisect_right(self._epochs, date)
+            date = self._epochs[epoch - 1] if epoch else datetime.min
+            key = (epoch, dst_cmdty, freshest)
+        tree = self._trees.get(key)
+        if tree is not None:
+            self._trees.move_to_end(key)
+            return tree
+        tree = _PathTree(self._commodities, date, dst_cmdty, freshest,
+                         self._latest)
+        if self._tree_cache_size:
+            self._trees[key] = tree
+            if len(self._trees) > self._tree_cache_size:
+                self._trees.popitem(last=False)
+        return tree
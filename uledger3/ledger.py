@@ -1,6 +1,7 @@
-from typing import Union
+from typing import Sequence, Union
 from decimal import Decimal
 import re
+import sys
 
 from uledger3 import parser
 from uledger3.parser import Amount, Lot, Transaction, \
@@ -9,7 +10,7 @@ from uledger3.parser import Amount, Lot, Transaction, \
 class LedgerError(Exception):
     def __init__(self, message: str,
                  entity: Entity | None = None,
-                 lines: list[str] | None = None):
+                 lines: Sequence[str] | None = None):
         position = None
         context = None
         if entity:
@@ -47,16 +48,20 @@ def transaction_has_unit_rates(txn: Transaction) -> Amount | None:
             return p.amount
     return None
 
-def _check_transaction_elide(
+def _sum_transaction(
         txn: Transaction, noelide: bool = False,
-        lines: list[str] | None = None) \
-        -> tuple[int, str]:
-    """Check everything related to elided postings in a transaction."""
+        lines: Sequence[str] | None = None) \
+        -> tuple["Balance", int, str]:
+    """Sum the postings of a transaction that are not virtual, and check
+    everything related to elided postings in one pass."""
+    balance = Balance()
     elide_index = None
     elide_account = None
     for i in range(len(txn.contents)):
         p = txn.contents[i]
-        if isinstance(p, Posting) and p.amount is None:
+        if not isinstance(p, Posting):
+            continue
+        if p.amount is None:
             if noelide:
                 raise BalanceError(
                     "Elided posting not allowed.", p, lines)
@@ -68,29 +73,27 @@ def _check_transaction_elide(
                     "More than one elided posting not allowed.", p, lines)
             elide_index = i
             elide_account = p.account
-    return (elide_index, elide_account)
+        elif not parser.is_virtual_account(p.account):
+            balance += p.amount
+    return (balance, elide_index, elide_account)
 
-def check_transaction(txn: Transaction, lines: list[str] | None = None,
+def check_transaction(txn: Transaction, lines: Sequence[str] | None = None,
                       noelide: bool = False):
+    if txn.normalised:
+        return None
     a = transaction_has_unit_rates(txn)
     if a:
         raise BalanceError(
             "Cannot check balance with unit rates.", a, lines)
-    elide_index, elide_account = _check_transaction_elide(txn, noelide, lines)
+    balance, elide_index, _ = _sum_transaction(txn, noelide, lines)
     if elide_index is not None:
         # There is no need to balance accounts because there is exactly one
         # elided posting.
         return None
-    a = Account("root")
-    for i in range(len(txn.contents)):
-        p = txn.contents[i]
-        if isinstance(p, Posting):
-            if p.amount is None or parser.is_virtual_account(p.account):
-                continue
-            a[p.account] += p.amount
-    if a.balance != 0:
+    if balance != 0:
         raise BalanceError(
-            f"Transaction unbalanced by {a.balance}.", txn, lines)
+            f"Transaction unbalanced by {balance}.", txn, lines)
+    txn.normalised = True
 
 def read_uledger_comment(comment: str) -> tuple[str, str] | None:
     m = re.match(";\s*\[uledger\]", comment)
@@ -106,32 +109,33 @@ def lexorder_commodity(cmdty: str | Lot) -> str:
     if isinstance(cmdty, str):
         return cmdty
     else:
-        from uledger3.printing import date2str
-        return f"{cmdty.commodity} {date2str(cmdty.date)}"
+        return cmdty.sort_key
 
-def unelide_transaction(txn: Transaction, lines: list[str] | None = None) \
+def unelide_transaction(txn: Transaction, lines: Sequence[str] | None = None) \
     -> None:
     """Replace elided postings with regular postings."""
-    check_transaction(txn, lines)
-    elide_index, elide_account = _check_transaction_elide(txn, lines=lines)
-    if elide_index is not None:
-        a = Account("root")
-        for i in range(len(txn.contents)):
-            p = txn.contents[i]
-            if isinstance(p, Posting):
-                if p.amount is None or parser.is_virtual_account(p.account):
-                    continue
-                a[p.account] += p.amount
-        for i in a.sorted_commodities():
-            if a.balance[i] == 0:
-                continue
+    if txn.normalised:
+        return None
+    a = transaction_has_unit_rates(txn)
+    if a:
+        raise BalanceError(
+            "Cannot check balance with unit rates.", a, lines)
+    balance, elide_index, elide_account = _sum_transaction(txn, lines=lines)
+    if elide_index is None:
+        if balance != 0:
+            raise BalanceError(
+                f"Transaction unbalanced by {balance}.", txn, lines)
+    else:
+        for i in sorted(balance, key=lexorder_commodity):
             txn.contents.insert(
                 elide_index + 1,
                 parser.Posting(
                     elide_account,
-                    parser.Amount(-a.balance[i], i)))
+                    parser.Amount(-balance[i], i)))
         txn.contents.pop(elide_index)
-    check_transaction(txn, lines=lines, noelide=True)
+    txn.normalised = True
+
+_ZERO = Decimal("0")
 
 class Balance(dict):
     def __init__(self, parent: "Balance" = None):
@@ -193,35 +197,311 @@ class Balance(dict):
     def copy(self):
         return self.__copy__()
     def __copy__(self):
+        # The entries are already checked and not zero.
         b = Balance()
-        for i in self:
-            b[i] = self[i]
+        dict.update(b, self)
+        return b
+    def __reduce__(self):
+        # Pickle would restore the entries through __setitem__, before the
+        # attributes that subclasses need to store them.
+        return (type(self), (), (dict(dict.items(self)), self.__dict__))
+    def __setstate__(self, state):
+        entries, attributes = state
+        self.__dict__.update(attributes)
+        dict.update(self, entries)
+    def _merge(self, other: "Balance"):
+        if not self and type(self) is Balance and type(other) is Balance:
+            dict.update(self, other)
+            return
+        for i in other:
+            if i in self:
+                self[i] += other[i]
+            else:
+                self[i] = other[i]
+    def _assign(self, other: "Balance"):
+        if not self and type(self) is Balance and type(other) is Balance:
+            dict.update(self, other)
+            return
+        for i in other:
+            self[i] = other[i]
+
+class FixedPointBalance(Balance):
+    """A Balance that stores each quantity as an integer count of units of
+    its last decimal place, so that adding amounts is integer arithmetic.
+
+    Quantities are converted back when read, and are the Decimals that
+    Balance would hold, exponent included. The parent must also be a
+    FixedPointBalance.
+    """
+    def __init__(self, parent: "FixedPointBalance" = None):
+        super().__init__(parent)
+        self._scales = {}
+    def _add(self, key, units: int, scale: int):
+        current = dict.get(self, key)
+        if current is None:
+            if units:
+                dict.__setitem__(self, key, units)
+                self._scales[key] = scale
+            return
+        current_scale = self._scales[key]
+        if scale > current_scale:
+            current *= 10 ** (scale - current_scale)
+            self._scales[key] = scale
+        elif scale < current_scale:
+            units *= 10 ** (current_scale - scale)
+        current += units
+        if current:
+            dict.__setitem__(self, key, current)
+        else:
+            dict.__delitem__(self, key)
+            del self._scales[key]
+    def _apply(self, amount: Amount, sign: int):
+        if not isinstance(amount, Amount):
+            raise TypeError(f"Unsupported type {type(amount)}.")
+        if amount.unit_rate:
+            raise LedgerError("Unit rate cannot be applied.", amount)
+        self._check_type(amount.commodity, amount.quantity)
+        units, scale = amount.units
+        b = self
+        while b is not None:
+            b._add(amount.commodity, sign * units, scale)
+            b = b._parent
+        return self
+    def __iadd__(self, amount: Amount):
+        return self._apply(amount, 1)
+    def __isub__(self, amount: Amount):
+        return self._apply(amount, -1)
+    def __getitem__(self, key):
+        units = dict.get(self, key)
+        if units is None:
+            return self.__missing__(key)
+        return Decimal(units).scaleb(-self._scales[key])
+    def __setitem__(self, key, val):
+        self._check_type(key, val)
+        if key in self:
+            dict.__delitem__(self, key)
+            del self._scales[key]
+        self._add(key, *parser.decimal_units(val))
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self._scales[key]
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        x = self[key]
+        del self[key]
+        return x
+    def clear(self):
+        dict.clear(self)
+        self._scales.clear()
+    def items(self):
+        return [(i, self[i]) for i in self]
+    def values(self):
+        return [self[i] for i in self]
+    def __eq__(self, other):
+        if len(self) == 0 and other == len(self):
+            return True
+        if not isinstance(other, Balance) or len(self) != len(other):
+            return False
+        return all(i in other and self[i] == other[i] for i in self)
+    def __repr__(self):
+        return repr(dict(self.items()))
+    def __copy__(self):
+        b = FixedPointBalance()
+        dict.update(b, dict.items(self))
+        b._scales = self._scales.copy()
+        return b
+    def _merge(self, other: Balance):
+        if not isinstance(other, FixedPointBalance):
+            return super()._merge(other)
+        for i, units in dict.items(other):
+            self._add(i, units, other._scales[i])
+
+# The largest relative error of rounding a result to the nearest float.
+_UNIT_ROUNDOFF = sys.float_info.epsilon / 2
+
+class ApproximateBalance(Balance):
+    """A Balance that stores quantities as binary floats, for reports that
+    do not need to be exact, along with a bound on the absolute error of
+    each.
+
+    Quantities read from it are floats. A quantity within its error bound
+    of zero is removed, and the error bound is kept. The parent must also
+    be an ApproximateBalance.
+    """
+    def __init__(self, parent: "ApproximateBalance" = None):
+        super().__init__(parent)
+        self._errors = {}
+    def _check_type(self, key, val = None):
+        if not (isinstance(key, str) or
+                isinstance(key, Lot)):
+            raise TypeError(f"Incorrect type: {type(key)}.")
+        if val and not isinstance(val, (Decimal, float)):
+            raise TypeError(f"Incorrect type: {type(val)}.")
+    def __missing__(self, key):
+        self._check_type(key)
+        return 0.0
+    def error(self, key) -> float:
+        """A bound on the absolute error of the quantity of a commodity."""
+        return self._errors.get(key, 0.0)
+    def add(self, key, value: float, error: float = 0.0):
+        """Add a quantity known to within an absolute error."""
+        total = dict.get(self, key, 0.0) + value
+        error += self._errors.get(key, 0.0) + _UNIT_ROUNDOFF * abs(total)
+        if abs(total) <= error:
+            dict.pop(self, key, None)
+            error += abs(total)
+        else:
+            dict.__setitem__(self, key, total)
+        self._errors[key] = error
+    def _apply(self, amount: Amount, sign: int):
+        if not isinstance(amount, Amount):
+            raise TypeError(f"Unsupported type {type(amount)}.")
+        if amount.unit_rate:
+            raise LedgerError("Unit rate cannot be applied.", amount)
+        self._check_type(amount.commodity, amount.quantity)
+        value, error = _to_float(amount.quantity)
+        b = self
+        while b is not None:
+            b.add(amount.commodity, sign * value, error)
+            b = b._parent
+        return self
+    def __iadd__(self, amount: Amount):
+        return self._apply(amount, 1)
+    def __isub__(self, amount: Amount):
+        return self._apply(amount, -1)
+    def __setitem__(self, key, val):
+        self._check_type(key, val)
+        dict.pop(self, key, None)
+        self._errors.pop(key, None)
+        self.add(key, *_to_float(val))
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._errors.pop(key, None)
+    def pop(self, key, *default):
+        self._errors.pop(key, None)
+        return dict.pop(self, key, *default)
+    def clear(self):
+        dict.clear(self)
+        self._errors.clear()
+    def __copy__(self):
+        b = ApproximateBalance()
+        dict.update(b, self)
+        b._errors = self._errors.copy()
         return b
+    def _merge(self, other: Balance):
+        for i in other:
+            value, error = _to_float(other[i])
+            if isinstance(other, ApproximateBalance):
+                error = other._errors[i]
+            self.add(i, value, error)
+    def _assign(self, other: Balance):
+        super()._assign(other)
+        if isinstance(other, ApproximateBalance):
+            for i in other:
+                self._errors[i] = other._errors[i]
+
+def to_decimal(quantity: Decimal | float, places: int | None = None) \
+        -> Decimal:
+    """A quantity as a Decimal, rounded to a number of decimal places if
+    given.
+
+    A float becomes the shortest Decimal that converts back to it, which is
+    how approximate balances are reported.
+    """
+    if isinstance(quantity, float):
+        quantity = Decimal(repr(quantity))
+    if places is not None:
+        # Adding zero turns a rounded -0 into 0.
+        quantity = quantity.quantize(Decimal(10) ** -places) + 0
+    return quantity
+
+def _to_float(quantity: Decimal | float) -> tuple[float, float]:
+    if isinstance(quantity, float):
+        return (quantity, 0.0)
+    x = float(quantity)
+    return (x, _UNIT_ROUNDOFF * abs(x))
+
+_EMPTY_SUMMARY = (False, 0, None)
 
 class Account():
-    def __init__(self, name: str, parent: Union["Account", None] = None):
+    def __init__(self, name: str, parent: Union["Account", None] = None,
+                 deferred: bool = False, fixed_point: bool = False,
+                 approximate: bool = False):
         if not name or name.find(":") != -1:
             raise ValueError(f"Account name '{name}' is improperly formed.")
         self._name = name
         self._parent = parent
         self._children = {}
+        # Accounts below this one by the exact name they were looked up by.
+        self._lookup = {}
+        # Whether anything here or below has a balance, how many children
+        # do, and the child if only one does. None when it needs to be
+        # worked out again, which is also true of all the ancestors then.
+        self._summary = _EMPTY_SUMMARY
+        # The names of the children in order, until one is added.
+        self._sorted_children = None
+        # A deferred tree only records amounts on the account they are
+        # applied to. The total including children is rolled up when the
+        # balance is read, and kept until something below changes. Writing
+        # to the balance of a deferred account directly is not supported.
+        # Both modes are inherited, as is keeping balances in fixed point or
+        # in floats.
         if parent is not None:
-            self._balance = Balance(parent.balance)
+            deferred = parent._deferred
+            fixed_point = parent._fixed_point
+            approximate = parent._approximate
+        if fixed_point and approximate:
+            raise ValueError("Fixed point balances cannot be approximate.")
+        self._deferred = deferred
+        self._fixed_point = fixed_point
+        self._approximate = approximate
+        if fixed_point:
+            balance = FixedPointBalance
+        elif approximate:
+            balance = ApproximateBalance
         else:
-            self._balance = Balance()
+            balance = Balance
+        if deferred:
+            self._own = balance()
+            self._balance = balance()
+            self._dirty = False
+        elif parent is not None:
+            self._balance = balance(parent.balance)
+        else:
+            self._balance = balance()
     def __getitem__(self, name):
+        account = self._lookup.get(name)
+        if account is not None:
+            return account
         hierarchy = [x.strip() for x in name.split(":")]
         account = self
         for i in hierarchy:
             if i not in account._children:
                 account._children[i] = Account(i, account)
+                account._sorted_children = None
             account = account._children[i]
+        self._lookup[name] = account
         return account
     def __setitem__(self, name, value):
         if not isinstance(value, Account):
             raise TypeError(f"Unsupported type: {type(value)}")
         x = self[name]
+        if x is value:
+            # "account[name] += amount" assigns the same account back.
+            return
         x.parent.children[x.name] = value
+        x.parent._sorted_children = None
+        if x.parent._deferred:
+            x.parent._invalidate()
+        x.parent._forget_summary()
+        # Lookups above may lead into the replaced account.
+        x = x.parent
+        while x is not None:
+            x._lookup.clear()
+            x = x._parent
     @property
     def name(self):
         return self._name
@@ -232,25 +512,115 @@ class Account():
     def children(self):
         return self._children
     @property
+    def deferred(self):
+        return self._deferred
+    @property
+    def fixed_point(self):
+        return self._fixed_point
+    @property
+    def approximate(self):
+        return self._approximate
+    @property
     def balance(self):
+        if self._deferred and self._dirty:
+            self._roll_up()
         return self._balance
+    def _invalidate(self):
+        # The ancestors of a dirty account are always dirty, so stop at the
+        # first one that already is.
+        x = self
+        while x is not None and not x._dirty:
+            x._dirty = True
+            x = x._parent
+    def _forget_summary(self):
+        x = self
+        while x is not None and x._summary is not None:
+            x._summary = None
+            x = x._parent
+    def _summarise(self) -> tuple[bool, int, Union["Account", None]]:
+        s = self._summary
+        if s is None:
+            count = 0
+            child = None
+            for c in self._children.values():
+                if c._summarise()[0]:
+                    count += 1
+                    child = c
+            s = (count > 0 or self.balance != 0, count,
+                 child if count == 1 else None)
+            self._summary = s
+        return s
+    def is_deep_empty(self) -> bool:
+        """Neither this account nor any account below it has a balance.
+
+        This and the two below are kept up to date as amounts are applied
+        to accounts, but not if a balance is changed directly.
+        """
+        return not self._summarise()[0]
+    def count_nonempty_children(self) -> int:
+        return self._summarise()[1]
+    def nonempty_child(self) -> Union["Account", None]:
+        """The only child that is not deep empty, if there is one."""
+        return self._summarise()[2]
+    def _roll_up(self):
+        b = self._balance
+        b.clear()
+        b._merge(self._own)
+        for child in self._children.values():
+            b._merge(child.balance)
+        self._dirty = False
     def apply(self, posting: Posting):
         account = parser.strip_virtual_account(posting.account)
-        amount = posting.amount
-        self[account] += amount
+        account = self[account]
+        account += posting.amount
     def __iadd__(self, amount: Amount):
-        self._balance += amount
+        if self._deferred:
+            self._own += amount
+            self._invalidate()
+        else:
+            self._balance += amount
+        if self._summary is not None:
+            self._forget_summary()
         return self
     def __isub__(self, amount: Amount):
-        self._balance -= amount
+        if self._deferred:
+            self._own -= amount
+            self._invalidate()
+        else:
+            self._balance -= amount
+        if self._summary is not None:
+            self._forget_summary()
         return self
+    def _merge(self, b: Balance):
+        # Add every amount in the balance.
+        self._forget_summary()
+        if self._deferred:
+            self._own._merge(b)
+            self._invalidate()
+            return
+        x = self._balance
+        while x is not None:
+            x._merge(b)
+            x = x._parent
+    def merge(self, other: "Account"):
+        """Add the balances of another tree of accounts to this one."""
+        for name, child in other.children.items():
+            self[name].merge(child)
+        own = other._excluding_children()
+        if own:
+            self._merge(own)
     def __str__(self):
         return f"Account({self.name}, balance={self.balance})"
     def sorted_commodities(self):
         b = list(self.balance.keys())
         b.sort(key=lexorder_commodity)
         return b
-    def sorted_children(self, key=lambda x: x.name):
+    def sorted_children(self, key=None):
+        if key is None:
+            if self._sorted_children is None:
+                b = sorted(self._children.values(), key=lambda x: x.name)
+                self._sorted_children = [x.name for x in b]
+            return list(self._sorted_children)
         b = list(self.children.values())
         b.sort(key=key)
         return [x.name for x in b]
@@ -260,9 +630,35 @@ class Account():
             return x.full_name() + ":" + self.name
         return self.name
     def balance_excluding_children(self):
+        if self._deferred:
+            return self._own.copy()
+        return self._excluding_children()
+    def _excluding_children(self) -> Balance:
+        # For a deferred account this is its own balance, not a copy, so it
+        # must not be changed.
+        if self._deferred:
+            return self._own
         excl = self._balance.copy()
-        for child in self._children:
-            child_balance = self._children[child].balance
-            for cmdty in child_balance:
-                excl[cmdty] -= child_balance[cmdty]
+        if isinstance(excl, ApproximateBalance):
+            # Subtracting adds the children's error bounds, including those
+            # of quantities removed as zero.
+            for child in self._children.values():
+                child_balance = child.balance
+                for cmdty, error in child_balance._errors.items():
+                    excl.add(cmdty, -child_balance[cmdty], error)
+            return excl
+        if type(excl) is not Balance:
+            for child in self._children.values():
+                child_balance = child.balance
+                for cmdty in child_balance:
+                    excl[cmdty] -= child_balance[cmdty]
+            return excl
+        # What "excl[cmdty] -= ..." does, without checking the entries again.
+        for child in self._children.values():
+            for cmdty, qty in dict.items(child.balance):
+                x = dict.get(excl, cmdty, _ZERO) - qty
+                if x:
+                    dict.__setitem__(excl, cmdty, x)
+                else:
+                    dict.pop(excl, cmdty, None)
         return excl
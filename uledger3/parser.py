@@ -1,7 +1,9 @@
 from typing import Union
 from typing import NamedTuple
 from typing import Iterable
+from typing import Iterator
 from datetime import datetime
+import functools
 import re
 from decimal import Decimal
 
@@ -46,6 +48,19 @@ class Journal():
         self.declared_accounts: set[str] = set()
         self.declared_commodity_formats: dict[str, CommodityFormat] = {}
         self.inferred_commodity_formats: dict[str, CommodityFormat] = {}
+        self._interned: dict = {}
+    def intern(self, x):
+        """Return the object equal to x that the journal already holds.
+
+        Parsed commodities, accounts and lots are interned, so equal values
+        share one object (and one cached hash). Lots are not interned while
+        contents are streamed, since there may be any number of them.
+        """
+        if isinstance(x, Lot):
+            # Equal prices may still be written differently.
+            key = (x, x.price.quantity.as_tuple().exponent)
+            return self._interned.setdefault(key, x)
+        return self._interned.setdefault(x, x)
     def get_commodity_format(self, commodity: str) -> CommodityFormat | None:
         if commodity in self.declared_commodity_formats:
             return self.declared_commodity_formats[commodity]
@@ -61,43 +76,170 @@ class Span(NamedTuple):
     start: Position
     end: Position
 
+_new_tuple = tuple.__new__
+
+# Entities keep their span packed into a single int, 16 bits each for the
+# columns and the number of lines spanned and the rest for the first line.
+# Spans that do not fit are kept as they are.
+_MASK = (1 << 16) - 1
+
+def _pack_span(start_line: int, start_column: int,
+               end_line: int, end_column: int) -> int | Span:
+    try:
+        lines = end_line - start_line
+        if (start_line >= 0 and 0 <= lines <= _MASK and
+            0 <= start_column <= _MASK and 0 <= end_column <= _MASK):
+            return (((start_line << 16 | lines) << 16 | start_column) << 16
+                    | end_column)
+    except TypeError:
+        pass
+    return Span(Position(start_line, start_column),
+                Position(end_line, end_column))
+
+def _unpack_span(span: int | Span | None) -> Span | None:
+    if type(span) is not int:
+        return span
+    start_line = span >> 48
+    # tuple.__new__ skips the Python-level NamedTuple constructors.
+    return _new_tuple(Span, (
+        _new_tuple(Position, (start_line, span >> 16 & _MASK)),
+        _new_tuple(Position, ((span >> 32 & _MASK) + start_line,
+                              span & _MASK))))
+
+def _extend_span(span: int | Span, end_line: int, end_column: int) \
+    -> int | Span:
+    if type(span) is int:
+        return _pack_span(span >> 48, span >> 16 & _MASK,
+                          end_line, end_column)
+    return _pack_span(*span.start, end_line, end_column)
+
+def _unpickle_entity(cls: type, args: tuple, span: int | Span | None,
+                     contents: list | None) -> "Entity":
+    x = cls(*args)
+    x._span = span
+    if contents is not None:
+        x.contents = contents
+    return x
+
 class Entity():
+    __slots__ = ("_span",)
     def __init__(self, span: Span | None = None):
-        self.span: Span | None = span
+        self._span = span and _pack_span(*span.start, *span.end)
+    @property
+    def span(self) -> Span | None:
+        return _unpack_span(self._span)
+    @span.setter
+    def span(self, span: Span | None) -> None:
+        self._span = span and _pack_span(*span.start, *span.end)
+    def _reduce_args(self) -> tuple:
+        return ()
+    def __reduce__(self):
+        # Pickle as constructor arguments and the packed span; this is
+        # much cheaper than the default state when parsed journals are
+        # shipped between processes.
+        return (_unpickle_entity,
+                (type(self), self._reduce_args(), self._span,
+                 getattr(self, "contents", None)))
 
 class AccountDecl(Entity):
+    __slots__ = ("account", "contents")
     def __init__(self, account: str):
         super().__init__()
         self.account = account
         self.contents: list[AccountAlias | str] = []
+    def _reduce_args(self) -> tuple:
+        return (self.account,)
 
 class CommodityDecl(Entity):
+    __slots__ = ("commodity", "contents")
     def __init__(self, commodity: str):
         super().__init__()
         self.commodity = commodity
         self.contents: list[CommodityFormat | str] = []
+    def _reduce_args(self) -> tuple:
+        return (self.commodity,)
 
 class PriceDecl(Entity):
+    __slots__ = ("commodity", "date", "price")
     def __init__(self, commodity: str, date: datetime, price: "Amount"):
         super().__init__()
         self.commodity = commodity
         self.date = date
         self.price = price
+    def _reduce_args(self) -> tuple:
+        return (self.commodity, self.date, self.price)
 
 class Transaction(Entity):
+    __slots__ = ("date", "status", "payee", "contents", "_normalised")
     def __init__(self, date: datetime, status: str, payee: str):
         super().__init__()
         self.date = date
         self.status = status
         self.payee = payee
         self.contents: list[str | Posting] = []
+        self._normalised = None
+    def _reduce_args(self) -> tuple:
+        return (self.date, self.status, self.payee)
+    @property
+    def normalised(self) -> bool:
+        """The postings are known to balance with none elided.
+
+        Any change to the contents, or to the account or amount of a
+        posting, resets this.
+        """
+        x = self._normalised
+        return (x is not None and x[0] is self.contents and
+                x[1] == self._fingerprint())
+    @normalised.setter
+    def normalised(self, value: bool):
+        if value:
+            self._normalised = (self.contents, self._fingerprint())
+        else:
+            self._normalised = None
+    def _fingerprint(self) -> list:
+        # Comparing this is much cheaper than summing the postings again.
+        return [(x, x.account, x.amount) if isinstance(x, Posting) else x
+                for x in self.contents]
 
-class Lot(NamedTuple):
+# How dates are written out, and so how lots with the same commodity are
+# ordered.
+DATE_FORMAT = "%Y/%m/%d"
+
+class _Lot(NamedTuple):
     commodity: str
     date: datetime
     price: "Amount"
 
+class Lot(_Lot):
+    # Lots are used as Balance keys, and hashing one means hashing its
+    # price, so the hash is computed once.
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = tuple.__hash__(self)
+            return self._hash
+    def __reduce__(self):
+        # The cached hash is only valid within this process.
+        return (Lot, tuple(self))
+    @property
+    def sort_key(self) -> str:
+        """The commodity and date, which is how lots are ordered."""
+        try:
+            return self._sort_key
+        except AttributeError:
+            self._sort_key = f"{self.commodity} {self.date:{DATE_FORMAT}}"
+            return self._sort_key
+
+def decimal_units(quantity: Decimal) -> tuple[int, int]:
+    """Split a quantity into an integer count of units of its last digit
+    and the number of decimal places, e.g. 12.50 into (1250, 2)."""
+    sign, digits, exponent = quantity.as_tuple()
+    units = int("".join(map(str, digits)))
+    return (-units if sign else units, -exponent)
+
 class Amount(Entity):
+    __slots__ = ("_quantity", "_commodity", "_unit_rate", "_units")
     def __init__(self, quantity: Decimal, commodity: Lot | str,
                  unit_rate: Union["Amount", None] = None):
         super().__init__()
@@ -105,12 +247,20 @@ class Amount(Entity):
         self._commodity = commodity
         # Unit rate is specified with the "@" syntax.
         self._unit_rate = unit_rate
+        self._units = None
         if unit_rate:
             assert isinstance(commodity, str)
+    def _reduce_args(self) -> tuple:
+        return (self._quantity, self._commodity, self._unit_rate)
     @property
     def quantity(self):
         return self._quantity
     @property
+    def units(self) -> tuple[int, int]:
+        if self._units is None:
+            self._units = decimal_units(self._quantity)
+        return self._units
+    @property
     def commodity(self):
         return self._commodity
     @property
@@ -128,97 +278,112 @@ class Amount(Entity):
         return f"Amount({self.quantity}, {self.commodity}, {self.unit_rate})"
 
 class Posting(Entity):
+    __slots__ = ("account", "amount", "assertion")
     def __init__(self, account: str, amount: Amount, assertion: Amount = None):
         super().__init__()
         self.account = account
         self.amount = amount
         self.assertion = assertion
+    def _reduce_args(self) -> tuple:
+        return (self.account, self.amount, self.assertion)
+
+_DATE = re.compile(r"(\d{4})([/-])(\d{1,2})\2(\d{1,2})")
+_QUANTITY = re.compile(r"-?[0-9,]+(\.[0-9]+)?")
+_QUOTED_COMMODITY = re.compile(r"[\"']([^\"']+)[\"']")
+_UNQUOTED_COMMODITY = re.compile(r"[^\s@0-9-=\"'&]+")
+_RELAXED_COMMODITY = re.compile(r"[^\s@=\"']+")
+_HARD_SPACE = re.compile(r"[\s]{2,}|\t")
+_SPACE = re.compile(r"[\s]+")
+_ACCOUNT_NAME = re.compile(r"\S+(?: \S+)*")
+_KEYWORDS: dict[str, re.Pattern] = {}
+
+# Journals reuse few distinct dates, quantities and formats, so parsing
+# them is memoised; entities dated the same day also share one datetime.
+@functools.lru_cache(maxsize=1 << 16)
+def _parse_date_text(text: str) -> datetime:
+    m = _DATE.match(text)
+    return datetime(int(m.group(1)), int(m.group(3)), int(m.group(4)))
+
+@functools.lru_cache(maxsize=1 << 16)
+def _parse_quantity_text(text: str) -> tuple[Decimal, bool, int]:
+    point = text.find(".")
+    precision = len(text) - point - 1 if point >= 0 else 0
+    return (Decimal(text.replace(',', '')), "," in text, precision)
+
+_commodity_format = functools.lru_cache(maxsize=1024)(CommodityFormat)
 
 def parse_date(line: str, begin: int = 0) -> tuple[datetime | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match("(\d{4})/(\d{1,2})/(\d{1,2})", line)
-    if not m:
-        m = re.match("(\d{4})-(\d{1,2})-(\d{1,2})", line)
+    m = _DATE.match(line, begin)
     if not m:
         return (None, begin)
-    x = datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-    return (x, begin + m.end())
+    return (_parse_date_text(m.group(0)), m.end())
 
 def parse_quantity(line: str, begin: int = 0) \
     -> tuple[tuple[Decimal, int, bool] | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match("-?[0-9,]+(\.[0-9]+)?", line)
+    m = _QUANTITY.match(line, begin)
     if not m:
         return (None, begin)
-    comma = "," in m.group(0)
-    precision = 0
-    if m.group(1):
-        precision = len(m.group(1)) - 1
-    return ((Decimal(m.group(0).replace(',', '')), comma, precision),
-            begin + m.end())
+    return (_parse_quantity_text(m.group(0)), m.end())
 
 def parse_commodity(line: str, begin: int = 0, relaxed=False) \
     -> tuple[str | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    quoted = '["\']([^"\']+)["\']'
-    unquoted = '[^\s@0-9-="\'&]+'
-    if relaxed:
-        unquoted = '[^\s@="\']+'
-    m = re.match(quoted, line)
+    m = _QUOTED_COMMODITY.match(line, begin)
     if m:
-        return (m.group(1), begin + m.end())
-    m = re.match(unquoted, line)
+        return (m.group(1), m.end())
+    if relaxed:
+        m = _RELAXED_COMMODITY.match(line, begin)
+    else:
+        m = _UNQUOTED_COMMODITY.match(line, begin)
     if m:
-        return (m.group(0), begin + m.end())
+        return (m.group(0), m.end())
     return (None, begin)
 
 def parse_hard_space(line: str, begin: int = 0) \
     -> tuple[str | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match('[\s]{2,}|\t', line)
+    m = _HARD_SPACE.match(line, begin)
     if m:
-        return (m.group(0), begin + m.end())
+        return (m.group(0), m.end())
     return (None, begin)
 
 def parse_space(line: str, begin: int = 0) \
     -> tuple[str | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match('[\s]+', line)
+    m = _SPACE.match(line, begin)
     if m:
-        return (m.group(0), begin + m.end())
+        return (m.group(0), m.end())
     return (None, begin)
 
 def parse_account_name(line: str, begin: int = 0) \
     -> tuple[str | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match('[^\s]([^\s]| ?[^\s])*', line)
+    m = _ACCOUNT_NAME.match(line, begin)
     if m:
         x = m.group(0)
         if x[0] == "(" and x[-1] != ")":
             return (None, begin)
-        return (m.group(0), begin + m.end())
+        return (x, m.end())
     return (None, begin)
 
 def parse_keyword(keyword: str, line: str, begin: int = 0) \
     -> tuple[str | None, int]:
     if len(line) <= begin:
         return (None, len(line))
-    line = line[begin:]
-    m = re.match(keyword, line)
+    pattern = _KEYWORDS.get(keyword)
+    if pattern is None:
+        pattern = _KEYWORDS[keyword] = re.compile(keyword)
+    m = pattern.match(line, begin)
     if m:
-        return (m.group(0), begin + m.end())
+        return (m.group(0), m.end())
     return (None, begin)
 
 def parse_simple_amount(line: str, begin: int = 0) \
@@ -236,7 +401,7 @@ def parse_simple_amount(line: str, begin: int = 0) \
         quantity, comma, precision = quantity
         amount = Amount(quantity, commodity)
         return ((amount,
-                 CommodityFormat(comma, precision, "left", bool(space))),
+                 _commodity_format(comma, precision, "left", bool(space))),
                 consumed)
     else:
         # [quantity] [commodity]
@@ -248,7 +413,7 @@ def parse_simple_amount(line: str, begin: int = 0) \
         commodity, consumed = parse_commodity(line, consumed)
         amount = Amount(quantity, commodity)
         return ((amount,
-                 CommodityFormat(comma, precision, "right", bool(space))),
+                 _commodity_format(comma, precision, "right", bool(space))),
                 consumed)
 
 def parse_lot_date(line: str, begin: int = 0) -> tuple[datetime | None, int]:
@@ -331,17 +496,18 @@ def is_virtual_account(account: str) -> bool:
         return False
 
 class Parser():
-    def __init__(self, name: str, pedantic: bool = False):
+    def __init__(self, name: str, pedantic: bool = False,
+                 first_line: int = 1):
         self.journal = Journal(name)
-        self._current_line_number = 0
+        self._current_line_number = first_line - 1
         self._current_block = None
+        self._block_count = 0
         self._pedantic = pedantic
+        self._keep_contents = True
 
-    def _create_span(self, begin: int, end: int) -> Span:
-        return Span(
-            Position(self._current_line_number, begin),
-            Position(self._current_line_number, end)
-        )
+    def _create_span(self, begin: int, end: int) -> int | Span:
+        return _pack_span(self._current_line_number, begin,
+                          self._current_line_number, end)
 
     def _pedantic_check_commodity(self,
                                   commodity: str,
@@ -391,8 +557,9 @@ class Parser():
         amount_1, cmdty_fmt = amount_1
         if not amount_1.commodity and self.journal.default_commodity:
             amount_1 = Amount(amount_1.quantity, self.journal.default_commodity)
+        amount_1._commodity = self.journal.intern(amount_1.commodity)
         self._pedantic_check_commodity(amount_1.commodity, line, begin)
-        amount_1.span = self._create_span(begin, consumed - 1)
+        amount_1._span = self._create_span(begin, consumed - 1)
         self._update_inferred_commodity_format(amount_1.commodity, cmdty_fmt)
         space, consumed = parse_space(line, consumed)
         if len(line) <= consumed:
@@ -409,11 +576,12 @@ class Parser():
             amount_2, cmdty_fmt = amount_2
             if not amount_2.commodity and self.journal.default_commodity:
                 amount_2 = Amount(amount_2.quantity, self.journal.default_commodity)
-            amount_2.span = self._create_span(consumed_x, consumed - 1)
+            amount_2._commodity = self.journal.intern(amount_2.commodity)
+            amount_2._span = self._create_span(consumed_x, consumed - 1)
             self._pedantic_check_commodity(amount_2.commodity, line, consumed_x)
             self._update_inferred_commodity_format(amount_2.commodity, cmdty_fmt)
             x = Amount(amount_1.quantity, amount_1.commodity, amount_2)
-            x.span = self._create_span(begin, consumed - 1)
+            x._span = self._create_span(begin, consumed - 1)
             return (x, consumed)
         else:
             consumed_x = consumed
@@ -423,23 +591,27 @@ class Parser():
             date, price, cmdty_fmt = lot
             self._pedantic_check_commodity(price.commodity, line, consumed_x)
             self._update_inferred_commodity_format(price.commodity, cmdty_fmt)
+            price._commodity = self.journal.intern(price.commodity)
             lot = Lot(amount_1.commodity, date, price)
+            if self._keep_contents:
+                lot = self.journal.intern(lot)
             amount = Amount(amount_1.quantity, lot)
-            amount.span = self._create_span(begin, consumed - 1)
+            amount._span = self._create_span(begin, consumed - 1)
             return (amount, consumed)
 
     def _update_inferred_commodity_format(
             self, commodity: str, new_format: CommodityFormat) -> None:
-        if commodity in self.journal.inferred_commodity_formats:
-            old_format = self.journal.inferred_commodity_formats[commodity]
-            comma = old_format.comma or new_format.comma
-            precision = max(old_format.precision, new_format.precision)
-            position = old_format.position
-            space = old_format.space
-            self.journal.inferred_commodity_formats[commodity] = \
-                CommodityFormat(comma, precision, position, space)
-        else:
-            self.journal.inferred_commodity_formats[commodity] = new_format
+        formats = self.journal.inferred_commodity_formats
+        old_format = formats.get(commodity)
+        if old_format is None:
+            formats[commodity] = new_format
+        elif ((new_format.comma and not old_format.comma) or
+              new_format.precision > old_format.precision):
+            formats[commodity] = _commodity_format(
+                old_format.comma or new_format.comma,
+                max(old_format.precision, new_format.precision),
+                old_format.position,
+                old_format.space)
 
     def _parse_space_or_error(self,
                               message: str,
@@ -501,8 +673,9 @@ class Parser():
                 "Price declaration not well formed",
                 Position(self._current_line_number, consumed), line)
         price, fmt = price
+        price._commodity = self.journal.intern(price.commodity)
         self._update_inferred_commodity_format(price.commodity, fmt)
-        return PriceDecl(commodity, date, price)
+        return PriceDecl(self.journal.intern(commodity), date, price)
 
     def _finish_parse_transaction_start(self, line: str, begin: int = 0) \
         -> Transaction:
@@ -585,6 +758,7 @@ class Parser():
         elif account in self.journal.account_aliases:
             account = self.journal.account_aliases[account]
         self._pedantic_check_account(account, line, consumed_x)
+        account = self.journal.intern(account)
         consumed_x = consumed
         space, consumed = parse_space(line, consumed)
         comment, consumed = parse_comment(line, consumed)
@@ -604,77 +778,82 @@ class Parser():
                 Position(self._current_line_number, consumed), line)
         return Posting(account, amount, assertion)
 
+    def _parse_indented_line(self, line: str, line_span: int | Span) \
+        -> None:
+        if self._current_block is None:
+            raise ParseError(
+                "Unexpected indent",
+                Position(self._current_line_number, 0), line)
+        line_number = self._current_line_number
+        x = self._current_block
+        if isinstance(x, Transaction):
+            y = self._finish_parse_transaction_contents(line)
+            if isinstance(y, Posting):
+                y._span = line_span
+            x.contents.append(y)
+            x._span = _extend_span(x._span, line_number, len(line) - 1)
+        elif isinstance(x, CommodityDecl):
+            y = self._finish_parse_commodity_decl_contents(line)
+            if isinstance(y, CommodityFormat):
+                self.journal.declared_commodity_formats[x.commodity] = y
+            elif y == "default":
+                self.journal.default_commodity = x.commodity
+            x.contents.append(y)
+            x._span = _extend_span(x._span, line_number, len(line) - 1)
+        elif isinstance(x, AccountDecl):
+            y = self._finish_parse_account_decl_contents(line)
+            if isinstance(y, AccountAlias):
+                self.journal.account_aliases[y.alias] = x.account
+            x.contents.append(y)
+            x._span = _extend_span(x._span, line_number, len(line) - 1)
+        else:
+            raise ParseError(
+                "Unexpected indent",
+                Position(self._current_line_number, 0), line)
+
+    def _append(self, item) -> None:
+        self._current_block = item
+        self._block_count += 1
+        if self._keep_contents:
+            self.journal.contents.append(item)
+
     def parse_line(self, line: str) -> None:
         self._current_line_number += 1
 
         line = line.rstrip()
         if not line:
-            self.journal.contents.append(line)
+            self._append(line)
             return None
 
-        commodity, _ = parse_keyword("commodity", line)
-        account,   _ = parse_keyword("account", line)
-        P,         _ = parse_keyword("P", line)
-        tag,       _ = parse_keyword("tag", line)
-        date,      _ = parse_date(line)
-        indent,    _ = parse_space(line)
-        comment,   _ = parse_comment(line)
-
+        # Every kind of line is recognisable from its first character, so
+        # dispatch on it instead of probing each syntax in turn.
+        first = line[0]
         line_span = self._create_span(0, len(line) - 1)
-        line_end = Position(self._current_line_number, len(line) - 1)
 
-        if commodity:
+        if first.isspace():
+            self._parse_indented_line(line, line_span)
+        elif first == ";":
+            self._append(line)
+        elif first == "c" and line.startswith("commodity"):
             c = self._finish_parse_commodity_decl(line)
-            c.span = line_span
-            self.journal.contents.append(c)
+            c._span = line_span
+            self._append(c)
             self.journal.declared_commodities.add(c.commodity)
-        elif account:
+        elif first == "a" and line.startswith("account"):
             a = self._finish_parse_account_decl(line)
-            a.span = line_span
-            self.journal.contents.append(a)
+            a._span = line_span
+            self._append(a)
             self.journal.declared_accounts.add(a.account)
-        elif P:
+        elif first == "P":
             p = self._finish_parse_price_decl(line)
-            p.span = line_span
-            self.journal.contents.append(p)
-        elif date:
+            p._span = line_span
+            self._append(p)
+        elif first == "t" and line.startswith("tag"):
+            self._append(line)
+        elif _DATE.match(line):
             t = self._finish_parse_transaction_start(line)
-            t.span = line_span
-            self.journal.contents.append(t)
-        elif indent:
-            if len(self.journal.contents) == 0:
-                raise ParseError(
-                    "Unexpected indent",
-                    Position(self._current_line_number, 0), line)
-            x = self.journal.contents[-1]
-            if isinstance(x, CommodityDecl):
-                y = self._finish_parse_commodity_decl_contents(line)
-                if isinstance(y, CommodityFormat):
-                    self.journal.declared_commodity_formats[x.commodity] = y
-                elif y == "default":
-                    self.journal.default_commodity = x.commodity
-                x.contents.append(y)
-                x.span = Span(x.span.start, line_end)
-            elif isinstance(x, AccountDecl):
-                y = self._finish_parse_account_decl_contents(line)
-                if isinstance(y, AccountAlias):
-                    self.journal.account_aliases[y.alias] = x.account
-                x.contents.append(y)
-                x.span = Span(x.span.start, line_end)
-            elif isinstance(x, Transaction):
-                y = self._finish_parse_transaction_contents(line)
-                if isinstance(y, Posting):
-                    y.span = line_span
-                x.contents.append(y)
-                x.span = Span(x.span.start, line_end)
-            else:
-                raise ParseError(
-                    "Unexpected indent",
-                    Position(self._current_line_number, 0), line)
-        elif comment:
-            self.journal.contents.append(comment)
-        elif tag:
-            self.journal.contents.append(line)
+            t._span = line_span
+            self._append(t)
         else:
             raise ParseError(
                 "Unable to parse line",
@@ -683,3 +862,33 @@ class Parser():
     def parse_lines(self, lines: Iterable[str]) -> None:
         for i in lines:
             self.parse_line(i)
+
+    def iter_contents(self, lines: Iterable[str]) \
+        -> Iterator[str | Entity]:
+        """Parse lines, yielding each top-level item once it is complete.
+
+        Items are not kept in the journal's contents. Declarations and
+        inferred commodity formats are still recorded in the journal as the
+        iterator is consumed.
+        """
+        self._keep_contents = False
+        for line in lines:
+            block = self._current_block
+            count = self._block_count
+            self.parse_line(line)
+            if count and self._block_count != count:
+                yield block
+        block = self._current_block
+        self._current_block = None
+        if self._block_count:
+            self._block_count = 0
+            yield block
+
+    def iter_entities(self, lines: Iterable[str]) -> Iterator[Entity]:
+        """Parse lines, yielding each entity once its block is complete.
+
+        Like iter_contents(), but comments and blank lines are skipped.
+        """
+        for x in self.iter_contents(lines):
+            if isinstance(x, Entity):
+                yield x
@@ -5,7 +5,7 @@ from typing import Callable, List
 import uledger3.parser as parser
 from uledger3.parser import Amount, Lot, Transaction, \
     Posting, Position, Journal, Entity
-from uledger3.ledger import Account
+from uledger3.ledger import Account, to_decimal
 
 # https://docs.python.org/3/library/decimal.html#decimal.getcontext
 def moneyfmt(value, places=2, curr='', sep=',', dp='.',
@@ -65,7 +65,7 @@ def commodity2str(commodity: str) -> str:
     return f'"{commodity}"'
 
 def date2str(date: datetime) -> str:
-    return date.strftime('%Y/%m/%d')
+    return date.strftime(parser.DATE_FORMAT)
 
 def _is_representable_by_precision(amount: Amount, precision: int):
     x = amount.quantity.quantize(Decimal(10) ** -precision)
@@ -84,13 +84,17 @@ def lot2str(lot: Lot) -> str:
 def amount2str(amount: Amount, format_function,
                force_prec: bool = False, noquote: bool = False) \
     -> tuple[str, str]:
-    assert isinstance(amount.quantity, Decimal)
     if isinstance(amount.commodity, str):
         commodity = amount.commodity
     else:
         assert isinstance(amount.commodity, Lot)
         commodity = amount.commodity.commodity
     fmt = format_function(commodity)
+    if isinstance(amount.quantity, float):
+        # Approximate quantities are shown to the commodity's precision.
+        amount = Amount(to_decimal(amount.quantity, fmt.precision),
+                        amount.commodity)
+    assert isinstance(amount.quantity, Decimal)
     if force_prec or _is_representable_by_precision(amount, fmt.precision):
         precision = fmt.precision
     else:
@@ -121,18 +125,8 @@ def amount2str(amount: Amount, format_function,
 
 def _is_empty_parent(account: Account) -> bool:
     """All balance is contained in a single child account."""
-    if len(account.children) == 0:
-        return False
-    child = None
-    nonempty = 0
-    for c in account.children:
-        if not _account_is_deep_empty(account[c]):
-            nonempty += 1
-            child = account[c]
-    if nonempty != 1:
-        return False
-    if child and account.balance == child.balance:
-        return True
+    child = account.nonempty_child()
+    return child is not None and account.balance == child.balance
 
 def print_account_balance(account: Account, format_function: Callable,
                           padding: int = 20, separator: str = "  ",
@@ -179,25 +173,10 @@ def print_account_balance(account: Account, format_function: Callable,
         if not commodities:
             print("0".rjust(padding))
 
-def _account_is_deep_empty(account: Account) -> bool:
-    if account.balance != 0:
-        return False
-    for c in account.children:
-        if not _account_is_deep_empty(account[c]):
-            return False
-    return True
-
 def _first_child(account: Account) -> str:
     for c in account.children:
         return c
 
-def _count_nonzero_children(account: Account) -> int:
-    count = 0
-    for child in account.children:
-        if _account_is_deep_empty(account[child]): continue
-        count += 1
-    return count
-
 def _print_tree_balance(padding: int, account: Account, cmdty: str, separator: str,
                         ffunc: Callable, parents: List[float], chars: List[str],
                         prefix: str):
@@ -217,7 +196,7 @@ def _print_tree_balance(padding: int, account: Account, cmdty: str, separator: s
                 print(f"{amount} {account.name}")
             else:
                 line = amount + separator
-                if _count_nonzero_children(account):
+                if account.count_nonempty_children():
                     line += f"{' ' * 7} │ "
                 prefixlen = len(line)
                 print(line.rstrip())
@@ -235,7 +214,7 @@ def _print_tree_balance(padding: int, account: Account, cmdty: str, separator: s
                 line = amount + separator
                 for i in range(len(parents)):
                     line += f"{' ' * 7} │ "
-                if _count_nonzero_children(account):
+                if account.count_nonempty_children():
                     line += f"{' ' * 7} │ "
                 prefixlen = len(line)
                 print(line.rstrip())
@@ -257,9 +236,9 @@ def print_account_tree(account: Account, format_function: Callable,
             chars[-1] = " "
         else:
             chars[-1] = "│"
-    child_number = _count_nonzero_children(account)
+    child_number = account.count_nonempty_children()
     for child in account.sorted_children(lambda x: -x.balance[commodity]):
-        if _account_is_deep_empty(account[child]): continue
+        if account[child].is_deep_empty(): continue
         child_number -= 1
         last_child = child_number == 0
         if last_child:
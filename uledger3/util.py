@@ -1,27 +1,316 @@
+import bisect
+import locale
+import mmap
+import multiprocessing
+import os
+import sys
+from array import array
+from datetime import datetime
+from decimal import Decimal
+
+import uledger3.cache
 import uledger3.parser as parser
 import uledger3.ledger as ledger
 from uledger3.parser import Amount, Lot, Transaction, \
     Posting, Position, Journal, Entity, PriceDecl
 from uledger3.ledger import Account, Balance
 from uledger3.exchange import Exchange
-from typing import Callable
+from typing import BinaryIO, Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
 
-def read_journal(database: str, pedantic: bool = True) \
-        -> tuple[Journal, list[str]]:
-    p = parser.Parser(database, pedantic)
-    lines = []
-    with open(database, "r") as database:
-        for line in database:
-            line = line.rstrip()
-            p.parse_line(line)
-            lines.append(line)
-    journal = p.journal
+def _cache_directory(cache: str | None) -> str | None:
+    if cache is None:
+        cache = os.environ.get("ULEDGER3_CACHE")
+    return cache or None
+
+class JournalLines(Sequence[str]):
+    """The rstripped lines of a file, decoded on demand from an mmap.
+
+    Line start offsets are indexed as far as lines are iterated over or
+    looked up, so a journal that parses cleanly costs one pass over the
+    file and eight bytes per line.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self._size else b""
+        self._encoding = locale.getpreferredencoding(False)
+        self._starts = array("Q")
+        # End of the last indexed line.
+        self._end = 0
+
+    def _index(self, i: int) -> bool:
+        """Index lines up to i, returning whether line i exists."""
+        starts = self._starts
+        while len(starts) <= i:
+            if self._end >= self._size:
+                return False
+            starts.append(self._end)
+            j = self._map.find(b"\n", self._end)
+            self._end = self._size if j < 0 else j + 1
+        return True
+
+    def _line(self, i: int) -> str:
+        starts = self._starts
+        end = starts[i + 1] if i + 1 < len(starts) else self._end
+        return self._map[starts[i]:end].decode(self._encoding).rstrip()
+
+    def __len__(self) -> int:
+        self._index(sys.maxsize)
+        return len(self._starts)
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._line(j) for j in range(len(self))[i]]
+        if i < 0:
+            i += len(self)
+        if i < 0 or not self._index(i):
+            raise IndexError("line index out of range")
+        return self._line(i)
+
+    def __iter__(self) -> Iterator[str]:
+        i = 0
+        while self._index(i):
+            yield self._line(i)
+            i += 1
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and \
+            all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+def read_journal(database: str, pedantic: bool = True, jobs: int = 1,
+                 cache: str | None = None) \
+        -> tuple[Journal, JournalLines]:
+    """Parse a journal file and return it with its (rstripped) lines.
+
+    If cache names a directory (ULEDGER3_CACHE by default), a snapshot of
+    the parsed journal is kept there. While the file only grows at the
+    end, the snapshot is reused and just the new lines are parsed; any
+    other change means a full (sequential) parse.
+    """
+    directory = _cache_directory(cache)
+    lines = JournalLines(database)
+    if directory:
+        p = parser.Parser(database, pedantic)
+        p.journal.contents.extend(
+            _snapshot_contents(p, database, pedantic, directory))
+        journal = p.journal
+    elif jobs > 1:
+        journal = _parse_parallel(database, lines, pedantic, jobs)
+    else:
+        p = parser.Parser(database, pedantic)
+        p.parse_lines(lines)
+        journal = p.journal
     return (journal, lines)
 
-def apply_transaction(txn: Transaction, account: Account,
-                      real: bool = False, lots: bool = False,
-                      assertions: bool = False,
-                      lines: list[str] = None):
+def stream_journal(database: str, pedantic: bool = True,
+                   cache: str | None = None) \
+        -> tuple[Journal, Iterator[Entity]]:
+    """Parse a journal lazily, without keeping its contents or lines.
+
+    The returned journal's declarations and inferred commodity formats are
+    complete once the iterator is exhausted. Snapshots are read and written
+    as in read_journal().
+    """
+    p = parser.Parser(database, pedantic)
+    directory = _cache_directory(cache)
+    def entities():
+        if directory:
+            contents = _snapshot_contents(p, database, pedantic, directory)
+            for i in contents:
+                if isinstance(i, Entity):
+                    yield i
+        else:
+            with open(database, "r") as f:
+                yield from p.iter_entities(f)
+    return (p.journal, entities())
+
+def _decode_lines(f: BinaryIO, size: int = -1) -> Iterator[str]:
+    encoding = locale.getpreferredencoding(False)
+    while size:
+        line = f.readline()
+        if not line:
+            break
+        size -= len(line)
+        yield line.decode(encoding)
+
+def _snapshot_contents(p: parser.Parser, database: str, pedantic: bool,
+                       directory: str) -> Iterator[str | Entity]:
+    """Yield the top-level items of database, reusing a snapshot if able.
+
+    The snapshot covers the file up to the last line that begins a
+    top-level item, since the item before it can no longer change. If the
+    file still starts with those bytes, the snapshot's items are yielded
+    and parsing resumes there, with the declarations it recorded.
+    """
+    path = uledger3.cache.snapshot_path(directory, database, pedantic)
+    snapshot = uledger3.cache.SnapshotReader(path)
+    state = snapshot.state
+    boundary = uledger3.cache.last_boundary(database)
+    digests = uledger3.cache.prefix_digests(
+        database, [boundary, state.offset] if state else [boundary])
+    writer = None
+    try:
+        with open(database, "rb") as f:
+            if (state and state.offset <= boundary and
+                    digests.get(state.offset) == state.prefix_digest):
+                f.seek(state.offset)
+                # The line at the old boundary may have become indented, or
+                # the file may have been cut back to it.
+                line = f.readline()
+                if not line or not uledger3.cache.starts_item(line):
+                    state = None
+                f.seek(state.offset if state else 0)
+            else:
+                state = None
+            if state:
+                yield from snapshot
+                uledger3.cache.restore_journal_state(p.journal, state.journal)
+                p._current_line_number = state.line_number
+            begin = state.offset if state else 0
+            head = p.iter_contents(_decode_lines(f, boundary - begin))
+            if state and state.offset == boundary:
+                yield from head
+            else:
+                writer = uledger3.cache.SnapshotWriter(
+                    path, snapshot if state else None)
+                for batch in uledger3.cache.batches(head):
+                    writer.write(batch)
+                    yield from batch
+                writer.write_state(uledger3.cache.SnapshotState(
+                    boundary, digests[boundary], p._current_line_number,
+                    uledger3.cache.journal_state(p.journal)))
+            yield from p.iter_contents(_decode_lines(f))
+        if writer:
+            snapshot.close()
+            writer.commit()
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    finally:
+        snapshot.close()
+
+def _copy_declarations(journal: Journal) -> Journal:
+    x = Journal(journal.name)
+    x.default_commodity = journal.default_commodity
+    x.account_aliases = journal.account_aliases.copy()
+    x.declared_commodities = journal.declared_commodities.copy()
+    x.declared_accounts = journal.declared_accounts.copy()
+    x.declared_commodity_formats = journal.declared_commodity_formats.copy()
+    return x
+
+def _split_journal(name: str, lines: Sequence[str], chunks: int) \
+        -> tuple[list[tuple[int, list[str], Journal]], Journal] | None:
+    """Split lines into chunks that start at top-level entities.
+
+    Each chunk is returned as (begin, lines, declarations), where
+    declarations holds the commodity and account declarations made before
+    begin. The lines are kept as they are read, so that each is decoded
+    once. The declarations of the whole file are returned alongside.
+    Returns None if a declaration fails to parse.
+    """
+    size = max(len(lines) // chunks, 1)
+    decls = parser.Parser(name)
+    result = []
+    begin = 0
+    chunk: list[str] = []
+    in_decl = False
+    declarations = _copy_declarations(decls.journal)
+    previous = None
+    for i, line in enumerate(lines):
+        if not line:
+            in_decl = False
+            previous = line
+            chunk.append(line)
+            continue
+        indented = line[0].isspace()
+        if (not indented and i - begin >= size and not previous):
+            result.append((begin, chunk, declarations))
+            declarations = _copy_declarations(decls.journal)
+            begin = i
+            chunk = []
+        chunk.append(line)
+        if not indented:
+            in_decl = (line.startswith("commodity") or
+                       line.startswith("account"))
+        if in_decl:
+            try:
+                decls.parse_line(line)
+            except parser.ParseError:
+                return None
+        previous = line
+    result.append((begin, chunk, declarations))
+    return (result, decls.journal)
+
+def _parse_chunk(name: str, pedantic: bool, lines: list[str],
+                 first_line: int, declarations: Journal) -> Journal:
+    p = parser.Parser(name, pedantic, first_line)
+    p.journal = declarations
+    p.parse_lines(lines)
+    return p.journal
+
+def _intern_amount(journal: Journal, amount: Amount | None):
+    if amount is None:
+        return
+    if isinstance(amount.commodity, Lot):
+        _intern_amount(journal, amount.commodity.price)
+    amount._commodity = journal.intern(amount.commodity)
+    _intern_amount(journal, amount.unit_rate)
+
+def _intern_contents(journal: Journal, contents: Iterable[str | Entity]):
+    # What the parser interns, for entities parsed in another process.
+    for x in contents:
+        if isinstance(x, Transaction):
+            for p in x.contents:
+                if isinstance(p, Posting):
+                    p.account = journal.intern(p.account)
+                    _intern_amount(journal, p.amount)
+                    _intern_amount(journal, p.assertion)
+        elif isinstance(x, PriceDecl):
+            x.commodity = journal.intern(x.commodity)
+            _intern_amount(journal, x.price)
+
+def _parse_parallel(name: str, lines: Sequence[str], pedantic: bool,
+                    jobs: int) -> Journal:
+    # Declarations change how later lines parse (aliases, the default
+    # commodity, pedantic checks), so they are read up front and each chunk
+    # starts from the declarations that precede it.
+    split = _split_journal(name, lines, 4 * jobs)
+    if split is None:
+        # Let the sequential parser report the first error in the file.
+        p = parser.Parser(name, pedantic)
+        p.parse_lines(lines)
+        return p.journal
+    chunks, declarations = split
+    p = parser.Parser(name, pedantic)
+    p.journal = _copy_declarations(declarations)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            _parse_chunk,
+            [name] * len(chunks),
+            [pedantic] * len(chunks),
+            [chunk for _, chunk, _ in chunks],
+            [begin + 1 for begin, _, _ in chunks],
+            [declarations for _, _, declarations in chunks])
+        for j in results:
+            _intern_contents(p.journal, j.contents)
+            p.journal.contents.extend(j.contents)
+            for commodity, fmt in j.inferred_commodity_formats.items():
+                p._update_inferred_commodity_format(commodity, fmt)
+    return p.journal
+
+def _transaction_postings(txn: Transaction, real: bool, lots: bool) \
+    -> Iterator[tuple[Posting, str, Amount]]:
+    """The postings of a transaction with the account and amount to apply."""
     ledger.unelide_transaction(txn)
     for p in txn.contents:
         if not isinstance(p, Posting):
@@ -33,22 +322,120 @@ def apply_transaction(txn: Transaction, account: Account,
         if not lots and isinstance(post_amount.commodity, Lot):
             post_amount = Amount(post_amount.quantity,
                                  post_amount.commodity.commodity)
-        account[post_account] += post_amount
+        yield (p, post_account, post_amount)
+
+def _check_assertion(expected: Amount, balance: Balance,
+                     lines: Sequence[str] | None, change: Decimal = 0):
+    # The balance plus a change not applied to it yet. An approximate
+    # balance passes if the asserted quantity is within its error bound.
+    cmdty = expected.commodity
+    quantity = balance[cmdty]
+    if isinstance(balance, ledger.ApproximateBalance):
+        error = balance.error(cmdty)
+        if change:
+            change, change_error = ledger._to_float(change)
+            quantity += change
+            error += change_error + ledger._UNIT_ROUNDOFF * abs(quantity)
+        if abs(Decimal(quantity) - expected.quantity) <= Decimal(error):
+            return
+    else:
+        quantity += change
+    actual = parser.Amount(quantity, cmdty)
+    if actual != expected: raise ledger.BalanceError(
+        f"Balance assertion failed: {expected} != {actual}.",
+        expected, lines)
+
+def apply_transaction(txn: Transaction, account: Account,
+                      real: bool = False, lots: bool = False,
+                      assertions: bool = False,
+                      lines: Sequence[str] | None = None):
+    for p, post_account, post_amount in \
+            _transaction_postings(txn, real, lots):
+        target = account[post_account]
+        target += post_amount
         if assertions and p.assertion:
-            cmdty = p.assertion.commodity
-            actual = parser.Amount(
-                account[post_account].balance[cmdty], p.assertion.commodity)
-            expected = p.assertion
-            if actual != expected: raise ledger.BalanceError(
-                f"Balance assertion failed: {expected} != {actual}.",
-                p.assertion, lines)
-
-def apply_journal(journal: Journal, account: Account,
-                  real: bool = False, lots: bool = False):
-    for txn in journal.contents:
+            _check_assertion(p.assertion, target.balance, lines)
+
+def apply_journal(journal: Journal | Iterable[Entity], account: Account,
+                  real: bool = False, lots: bool = False,
+                  assertions: bool = False,
+                  lines: Sequence[str] | None = None, jobs: int = 1):
+    """Apply every transaction in the journal to the account.
+
+    With more than one job, consecutive runs of transactions are applied
+    to separate trees by worker processes, which are then merged into the
+    account in order. Balance assertions are checked against the balance
+    before the run plus the run's own change up to the assertion. The
+    transactions are unelided in the workers, not in this process.
+    """
+    if isinstance(journal, Journal):
+        journal = journal.contents
+    if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+        _apply_parallel([i for i in journal if isinstance(i, Transaction)],
+                        account, real, lots, assertions, lines, jobs)
+        return
+    for txn in journal:
         if not isinstance(txn, Transaction):
             continue
-        apply_transaction(txn, account, real, lots)
+        apply_transaction(txn, account, real, lots, assertions, lines)
+
+# The transactions being applied by a worker process.
+_worker_transactions: list[Transaction] = []
+
+def _init_apply_worker(transactions: list[Transaction]):
+    global _worker_transactions
+    _worker_transactions = transactions
+
+def _apply_chunk(begin: int, end: int, real: bool, lots: bool,
+                 assertions: bool) \
+        -> tuple[Account, list[tuple[str, Decimal, Amount]],
+                 ledger.LedgerError | None]:
+    # Only the account an amount is applied to is updated, and assertions
+    # are recorded with the change to the asserted account so far. An
+    # error is returned with what was applied before it, and is raised
+    # once the assertions before it have been checked.
+    root = Account("root", deferred=True)
+    checks = []
+    try:
+        for txn in _worker_transactions[begin:end]:
+            for p, post_account, post_amount in \
+                    _transaction_postings(txn, real, lots):
+                target = root[post_account]
+                target += post_amount
+                if assertions and p.assertion:
+                    cmdty = p.assertion.commodity
+                    checks.append((post_account, target.balance[cmdty],
+                                   p.assertion))
+    except ledger.LedgerError as e:
+        return (root, checks, e)
+    return (root, checks, None)
+
+def _apply_parallel(transactions: list[Transaction], account: Account,
+                    real: bool, lots: bool, assertions: bool,
+                    lines: Sequence[str] | None, jobs: int):
+    # Sending transactions to a worker costs more than applying them, so
+    # the workers are forked and inherit the list instead.
+    size = -(-len(transactions) // jobs)
+    begins = range(0, len(transactions), max(size, 1))
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_apply_worker,
+            initargs=(transactions,)) as executor:
+        results = executor.map(
+            _apply_chunk,
+            begins,
+            [i + size for i in begins],
+            [real] * len(begins),
+            [lots] * len(begins),
+            [assertions] * len(begins))
+        for root, checks, error in results:
+            for name, change, expected in checks:
+                _check_assertion(expected, account[name].balance, lines,
+                                 change)
+            account.merge(root)
+            if error is not None:
+                raise error
 
 def transform_account(old_account: Account, new_account: Account,
                       transformer: Callable[[Balance, str], Balance],
@@ -66,8 +453,111 @@ def transform_account(old_account: Account, new_account: Account,
 
     b_new = transformer(b, old_account.name)
 
-    for cmdty in b_new:
-        if independent:
-            new_account.balance[cmdty] = b_new[cmdty]
+    # Error bounds are carried over when both accounts are approximate.
+    if independent:
+        new_account.balance._assign(b_new)
+        new_account._forget_summary()
+    else:
+        new_account._merge(b_new)
+
+class BalanceHistory():
+    """Balances of a journal as of any date.
+
+    The transactions are applied once in date order, and the balance of
+    every account (excluding children) is kept every "every" transactions
+    (unless it is 0) and, if "monthly", before the first transaction of
+    each month. A query
+    starts from the last checkpoint before the date, and applies only the
+    transactions after it. Results are deferred account trees unless an
+    account is given.
+    """
+    def __init__(self, journal: Journal | Iterable[Entity],
+                 real: bool = False, lots: bool = False,
+                 every: int = 1000, monthly: bool = False):
+        if isinstance(journal, Journal):
+            journal = journal.contents
+        self._real = real
+        self._lots = lots
+        # Sorting is stable, so transactions of a day keep their order.
+        self._transactions = sorted(
+            (x for x in journal if isinstance(x, Transaction)),
+            key=lambda x: x.date)
+        self._dates = [x.date for x in self._transactions]
+        self._indices: list[int] = []
+        self._checkpoints: list[dict[str, Balance]] = []
+        balances: dict[str, Balance] = {}
+        checkpoint: dict[str, Balance] = {}
+        previous = None
+        for i, txn in enumerate(self._transactions):
+            month = (txn.date.year, txn.date.month)
+            if (i == 0 or (every and i % every == 0) or
+                    (monthly and month != previous)):
+                # Only balances changed since the previous checkpoint are
+                # new; the rest are shared with it.
+                checkpoint = {name: b for name, b in balances.items() if b}
+                self._indices.append(i)
+                self._checkpoints.append(checkpoint)
+            previous = month
+            self._apply(balances, txn, checkpoint)
+        if not self._indices:
+            self._indices.append(0)
+            self._checkpoints.append({})
+
+    def _apply(self, balances: dict[str, Balance], txn: Transaction,
+               checkpoint: dict[str, Balance]):
+        for _, post_account, post_amount in \
+                _transaction_postings(txn, self._real, self._lots):
+            b = balances.get(post_account)
+            if b is None:
+                b = balances[post_account] = Balance()
+            elif b is checkpoint.get(post_account):
+                # Balances are shared with the checkpoint until changed.
+                b = balances[post_account] = b.copy()
+            b += post_amount
+
+    def _balances(self, date: datetime | None) -> dict[str, Balance]:
+        # Everything dated on or before the date.
+        if date is None:
+            end = len(self._transactions)
         else:
-            new_account += Amount(b_new[cmdty], cmdty)
+            end = bisect.bisect_right(self._dates, date)
+        k = bisect.bisect_right(self._indices, end) - 1
+        checkpoint = self._checkpoints[k]
+        balances = checkpoint.copy()
+        for i in range(self._indices[k], end):
+            self._apply(balances, self._transactions[i], checkpoint)
+        return balances
+
+    def _to_account(self, balances: dict[str, Balance],
+                    account: Account | None) -> Account:
+        if account is None:
+            account = Account("root", deferred=True)
+        for name, b in balances.items():
+            if b:
+                account[name]._merge(b)
+        return account
+
+    def balance(self, date: datetime | None,
+                account: Account | None = None) -> Account:
+        """Apply everything dated on or before the date to the account, or
+        to a new one."""
+        return self._to_account(self._balances(date), account)
+
+    def change(self, begin: datetime | None, end: datetime | None,
+               account: Account | None = None) -> Account:
+        """Apply everything dated after "begin", and on or before "end", to
+        the account, or to a new one. Either may be None for no limit."""
+        balances = self._balances(end)
+        if begin is None:
+            return self._to_account(balances, account)
+        for name, b in self._balances(begin).items():
+            x = balances.get(name)
+            if x is b:
+                # Unchanged since the same checkpoint.
+                del balances[name]
+                continue
+            # Copied, as it may be shared with a checkpoint.
+            x = balances[name] = x.copy() if x is not None else Balance()
+            for cmdty in b:
+                x -= Amount(b[cmdty], cmdty)
+        return self._to_account(balances, account)